@@ -7,20 +7,79 @@
 Archive and remove a user's home directory.
 
 Home directories are moved to trash instead of deleted immediately.
-If SSH keys are archived the user is notified.
+If SSH keys, private keys or credential files are archived the user is
+notified.
 Allows to perform a --dry-run.
+Archives are compressed on several cores, either as gzip file made of
+independently compressed blocks or with zstd.
+A list of users can be archived in a batch, several at once but only a few
+per filesystem, followed by a table of results.
+While the archive is written, the SHA-256 checksums of its files are written
+into a manifest next to it, against which the archive can be verified before
+the home is trashed.
+Instead of a compressed archive, the data of files can be kept once in a
+chunk store shared by all users, with a small index per user.
 
 Depends on trash-cli/trash:
 Linux: https://github.com/andreafrancia/trash-cli
 OS X: http://hasseg.org/trash/
+Depends on zstd for --compression zstd.
 """
 
 import argparse
+from collections import deque
+import copy
+import gzip
+import hashlib
 import logging
 import logging.handlers
+import multiprocessing
+import os
 import os.path
+import Queue
+import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import zlib
+
+
+# uncompressed bytes per gzip member, large enough to hardly cost ratio
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# gzip compression level, the one tar czf uses
+COMPRESSION_LEVEL = 6
+
+ARCHIVE_SUFFIXES = {"gzip": ".tar.gz", "zstd": ".tar.zst"}
+
+# manifests are named after their archive, e.g. user.tar.gz.sha256
+MANIFEST_SUFFIX = ".sha256"
+
+# tar headers and data are padded to blocks of this size
+TAR_BLOCK_SIZE = 512
+
+# tar member types holding the data of a regular file
+TAR_FILE_TYPES = ("0", "\0", "7")
+
+# store indexes are named after the user, e.g. user.tar.index
+INDEX_SUFFIX = ".tar.index"
+
+# data of files from this size on is kept in the store, not the index
+INLINE_SIZE = 32 * 1024
+
+# the data of a file is stored in chunks of this size
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# kinds of files which should not be archived unnoticed
+SENSITIVE_FILES = [
+    ("SSH keys", re.compile(r"(^|/)authorized_keys2?$")),
+    ("Private keys", re.compile(r"(^|/)(id_(rsa|dsa|ecdsa|ed25519)|"
+                                r"[^/]+\.(pem|key|p12|pfx))$")),
+    ("Credentials", re.compile(r"(^|/)(\.netrc|\.pgpass|\.git-credentials|"
+                               r"\.my\.cnf|\.s3cfg|\.aws/credentials|"
+                               r"\.docker/config\.json)$"))]
 
 
 def main():
@@ -29,10 +88,181 @@ def main():
     options = parse_arguments()
     log = create_logger(options)
 
-    archive_output = archive_home(options, log)
-    check_for_SSH_keys(archive_output, options, log)
+    if options.batch:
+        archive_homes(options, log)
+        return
+
+    if options.restore:
+        restore_home(options)
+        return
+
+    try:
+        process_home(options, log)
+    except ArchivalError, error:
+        sys.exit(str(error))
+
+
+class ArchivalError(Exception):
+    """Archiving or trashing a home directory failed, which was logged."""
+
+    pass
+
+
+def process_home(options, log):
+    """Archive, check and trash the home directory of options.user.
+
+    Returns the sensitive files archived, by kind.
+    """
+
+    sensitive_files = archive_home(options, log)
+    check_for_sensitive_files(sensitive_files, options, log)
+
+    if options.verify:
+        verify_home_archive(options, log)
+
     trash_home(options, log)
 
+    return sensitive_files or {}
+
+
+class Scheduler(object):
+    """Hand out users to workers, only a few per filesystem at once.
+
+    A user whose filesystem is busy does not hold up users on others.
+    """
+
+    def __init__(self, users, limit):
+        self.pending = users
+        self.limit = limit
+        self.active = {}
+        self.condition = threading.Condition()
+
+    def next(self):
+        """Wait for a user whose filesystem is free, None once all are out."""
+
+        with self.condition:
+            while self.pending:
+                for index, (user, device) in enumerate(self.pending):
+                    if self.active.get(device, 0) < self.limit:
+                        del self.pending[index]
+                        self.active[device] = self.active.get(device, 0) + 1
+                        return user, device
+
+                self.condition.wait()
+
+        return None
+
+    def done(self, device):
+        """Free the filesystem slot of a finished user."""
+
+        with self.condition:
+            self.active[device] -= 1
+            self.condition.notify_all()
+
+
+def archive_homes(options, log):
+    """Archive and trash the homes of a list of users concurrently.
+
+    Prints a table with the result and time taken per user.
+    """
+
+    users = read_users(options.batch)
+    scheduled = []
+
+    # homes are read concurrently only up to a limit per filesystem
+    for user in users:
+        home = os.path.expanduser("~{}".format(user))
+        try:
+            device = os.stat(home).st_dev
+        except OSError:
+            device = None
+        scheduled.append((user, device))
+
+    scheduler = Scheduler(scheduled, options.per_filesystem)
+    results = {}
+    workers = []
+
+    for _ in range(min(options.workers, len(users))):
+        worker = threading.Thread(target=archive_scheduled_homes,
+                                  args=(scheduler, options, log, results))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    for worker in workers:
+        worker.join()
+
+    print "{:<16} {:<10} {:>9} {:>10}".format("user", "result", "sensitive",
+                                               "time")
+
+    failed = 0
+    for user in users:
+        result, sensitive, elapsed = results[user]
+        if result == "failed":
+            failed += 1
+        print "{:<16} {:<10} {:>9} {:>8.1f} s".format(user, result, sensitive,
+                                                       elapsed)
+
+    if failed:
+        sys.exit("{} of {} homes could not be archived.".format(failed,
+                                                                len(users)))
+
+
+def archive_scheduled_homes(scheduler, options, log, results):
+    """Process users from the scheduler until none are left."""
+
+    while True:
+        scheduled = scheduler.next()
+        if scheduled is None:
+            return
+
+        user, device = scheduled
+        user_options = copy.copy(options)
+        user_options.user = user
+        start = time.time()
+
+        try:
+            if device is None:
+                log.error("Home of {} does not exist.".format(user))
+                result, sensitive = "failed", 0
+            else:
+                sensitive_files = process_home(user_options, log)
+                result = "dry-run" if options.dry_run else "archived"
+                sensitive = sum(len(paths)
+                                for paths in sensitive_files.values())
+        except ArchivalError:
+            result, sensitive = "failed", 0
+        # anything unexpected must not end the worker with the user unrecorded
+        except Exception, error:
+            log.error("Archiving home of {} failed unexpectedly. Error was: "
+                      "{}".format(user, error))
+            result, sensitive = "failed", 0
+        finally:
+            scheduler.done(device)
+
+        results[user] = (result, sensitive, time.time() - start)
+
+
+def read_users(path):
+    """Read user names, one per line, from a file or - for stdin.
+
+    Empty lines and lines starting with # are skipped, as are duplicates.
+    """
+
+    users = []
+    users_file = sys.stdin if path == "-" else open(path, "r")
+
+    try:
+        for line in users_file:
+            user = line.strip()
+            if user and not user.startswith("#") and user not in users:
+                users.append(user)
+    finally:
+        if users_file is not sys.stdin:
+            users_file.close()
+
+    return users
+
 
 def create_logger(options):
     """Set up global logging."""
@@ -69,63 +299,831 @@ def create_logger(options):
     return logger
 
 
-def check_for_SSH_keys(archive_output, options, log):
-    """Notify if authorized SSH key files have been archived."""
+def check_for_sensitive_files(sensitive_files, options, log):
+    """Notify if SSH keys, private keys or credentials have been archived."""
 
     if options.dry_run is True:
-        log.info("SSH Keys would be checked here.")
+        log.info("Sensitive files would be checked here.")
 
     else:
-        if "authorized_keys" in archive_output:
-            log.warn("SSH keys archived.")
+        for kind, _ in SENSITIVE_FILES:
+            if kind in sensitive_files:
+                log.warn("{} archived: {}".format(
+                    kind, ", ".join(sensitive_files[kind])))
 
 
 def parse_arguments():
     """Parse given command line arguments."""
 
     text_username = "the user whose home directory should be archived"
+    text_batch = ("archive the homes of the users listed in this file, one "
+                  "per line, - for stdin")
+    text_workers = "batch: homes archived at once (default: 4)"
+    text_per_filesystem = ("batch: homes archived at once from the same "
+                           "filesystem (default: 2)")
     text_dry_run = "run in simulated mode and only print actions"
     text_verbose = "display messages about program flow"
+    text_compression = "compress the archive with gzip or zstd (default: gzip)"
+    text_store = ("keep the data of files in this chunk store shared by all "
+                  "users and write an index instead of an archive")
+    text_restore = ("write the archive of the user, rebuilt from the store, "
+                    "to stdout")
+    text_verify = ("check the archive against its manifest before the home "
+                   "is trashed")
+    text_jobs = ("compress on this many cores (default: all, shared by the "
+                 "workers of a batch)")
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("user", help=text_username)
+    parser.add_argument("user", help=text_username, nargs="?")
+    parser.add_argument("-b", "--batch", help=text_batch, metavar="FILE")
+    parser.add_argument("-w", "--workers", help=text_workers, type=int,
+                        default=4)
+    parser.add_argument("--per-filesystem", help=text_per_filesystem,
+                        type=int, default=2)
     parser.add_argument("-d", "--dry-run", help=text_dry_run,
                         action="store_true")
     parser.add_argument("-v", "--verbose", help=text_verbose,
                         action="store_true")
+    parser.add_argument("-c", "--compression", help=text_compression,
+                        choices=["gzip", "zstd"], default="gzip")
+    parser.add_argument("-j", "--jobs", help=text_jobs, type=int)
+    parser.add_argument("--verify", help=text_verify, action="store_true")
+    parser.add_argument("-s", "--store", help=text_store, metavar="FOLDER")
+    parser.add_argument("--restore", help=text_restore, action="store_true")
 
     arguments = parser.parse_args()
+
+    if bool(arguments.user) == bool(arguments.batch):
+        parser.error("either a user or --batch is required")
+    if arguments.restore and not (arguments.store and arguments.user):
+        parser.error("--restore needs a user and --store")
+    if arguments.store and arguments.compression == "zstd":
+        parser.error("--store compresses chunks itself, not with zstd")
+    if arguments.workers < 1 or arguments.per_filesystem < 1:
+        parser.error("at least one worker per filesystem is required")
+
+    if arguments.jobs is None:
+        arguments.jobs = multiprocessing.cpu_count()
+        if arguments.batch:
+            arguments.jobs = max(1, arguments.jobs // arguments.workers)
+    elif arguments.jobs < 1:
+        parser.error("at least one job is required")
+
     return arguments
 
 
 def archive_home(options, log):
-    """Archive the specified user's home directory."""
+    """Archive the specified user's home directory.
+
+    Raises ArchivalError if that fails.
+    tar writes the uncompressed archive to a pipe, which is compressed on
+    several cores. Returns the sensitive files archived, by kind.
+    """
 
     home = os.path.expanduser("~{}".format(options.user))
-    tar_command = ["tar", "czpvf", "{}.tar.gz".format(options.user), home]
+    archive_path = get_archive_path(options)
+    tar_command = ["tar", "cpvf", "-", home]
+    compress_command = None
+
+    store = None
+
+    if options.store:
+        store = ChunkStore(options.store)
+    elif options.compression == "zstd":
+        compress_command = ["zstd", "-T{}".format(options.jobs), "-q", "-f",
+                            "-o", archive_path]
 
     try:
         if options.dry_run is True:
             log.info("Command to execute: {}".format(tar_command))
+            if store:
+                log.info("Storing into {} with index {}.".format(
+                    options.store, archive_path))
+            elif compress_command:
+                log.info("Compressing with: {}".format(compress_command))
+            else:
+                log.info("Compressing into {} with {} jobs.".format(
+                    archive_path, options.jobs))
+            log.info("Checksums would be written to {}{}.".format(
+                archive_path, MANIFEST_SUFFIX))
 
         else:
             log.info("Starting archival of home for user {}.".format(
                 options.user))
-            output = subprocess.check_output(tar_command,
-                                             stderr=subprocess.STDOUT)
+            output = run_archival(tar_command, compress_command, archive_path,
+                                  options.jobs, store)
             return output
 
-    except subprocess.CalledProcessError, error:
+    except (subprocess.CalledProcessError, EnvironmentError), error:
 
         error_message = "Could not complete archival process."
 
         log.error("{} Error was: {}".format(error_message, error))
-        sys.exit("{} Error was: {}".format(error_message, error))
+        raise ArchivalError("{} Error was: {}".format(error_message, error))
+
+
+def get_archive_path(options):
+    """Return the path of the archive, or store index, of options.user."""
+
+    if options.store:
+        return "{}{}".format(options.user, INDEX_SUFFIX)
+
+    return "{}{}".format(options.user, ARCHIVE_SUFFIXES[options.compression])
+
+
+def run_archival(tar_command, compress_command, archive_path, jobs,
+                 store=None):
+    """Run tar and compress its output, return the sensitive files archived.
+
+    Without a compress command the archive is compressed into gzip members
+    by a pool of processes, in order and with a bounded number of blocks in
+    flight, or given a store kept in it. The checksums of the archived files
+    are written into a manifest on the way. Raises CalledProcessError if tar
+    or the compressor fail.
+    """
+
+    tar = subprocess.Popen(tar_command, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE)
+
+    # the listing goes to stderr when the archive goes to stdout
+    sensitive_files = {}
+    reader = threading.Thread(target=read_listing,
+                              args=(tar.stderr, sensitive_files))
+    reader.daemon = True
+    reader.start()
+
+    completed = False
+    try:
+        with open(archive_path + MANIFEST_SUFFIX, "w") as manifest_file:
+            if store:
+                writer = StoreWriter(store, archive_path, jobs)
+                try:
+                    for _ in read_blocks(tar.stdout, manifest_file, jobs,
+                                         [writer]):
+                        pass
+                    writer.close()
+                finally:
+                    writer.terminate()
+
+            elif compress_command:
+                blocks = read_blocks(tar.stdout, manifest_file, jobs)
+                compressor = subprocess.Popen(compress_command,
+                                              stdin=subprocess.PIPE)
+                for block in blocks:
+                    compressor.stdin.write(block)
+                compressor.stdin.close()
+
+                if compressor.wait() != 0:
+                    raise subprocess.CalledProcessError(compressor.returncode,
+                                                        compress_command)
+            else:
+                blocks = read_blocks(tar.stdout, manifest_file, jobs)
+                with open(archive_path, "wb") as archive:
+                    compress_stream(blocks, archive, jobs)
+        completed = True
+
+    finally:
+        # tar would otherwise be left blocked on a full pipe
+        if not completed and tar.poll() is None:
+            tar.kill()
+        tar.wait()
+        reader.join()
+
+    if tar.returncode != 0:
+        raise subprocess.CalledProcessError(tar.returncode, tar_command)
+
+    return sensitive_files
+
+
+def read_listing(stream, sensitive_files):
+    """Collect sensitive files from tar's listing while it is written.
+
+    Only matching paths are kept, however many files are archived.
+    """
+
+    for line in iter(stream.readline, ""):
+        path = line.rstrip("\n")
+
+        for kind, pattern in SENSITIVE_FILES:
+            if pattern.search(path):
+                sensitive_files.setdefault(kind, []).append(path)
+
+    stream.close()
+
+
+def read_blocks(stream, manifest_file, jobs, listeners=()):
+    """Yield the blocks of a tar stream, writing a manifest of its files.
+
+    Further listeners follow the stream as well. The checksum threads only
+    start once the first block is read, after the processes compressing
+    the blocks have been forked.
+    """
+
+    checksums = ChecksumPool(manifest_file, jobs)
+    parser = TarStream([checksums] + list(listeners))
+
+    for block in iter(lambda: stream.read(BLOCK_SIZE), ""):
+        parser.feed(block)
+        yield block
+
+    checksums.close()
+
+
+def compress_stream(blocks, archive, jobs):
+    """Compress blocks on several cores into a file.
+
+    Every block becomes a gzip member of its own, gzip decompresses
+    concatenated members as a single file.
+    """
+
+    if jobs == 1:
+        for block in blocks:
+            archive.write(compress_block(block))
+        return
+
+    window = jobs * 2
+    pool = multiprocessing.Pool(jobs)
+    pending = deque()
+
+    try:
+        for block in blocks:
+            pending.append(pool.apply_async(compress_block, (block,)))
+
+            while pending and (len(pending) >= window or pending[0].ready()):
+                archive.write(pending.popleft().get())
+
+        while pending:
+            archive.write(pending.popleft().get())
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def compress_block(block):
+    """Compress a block into a complete gzip member."""
+
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED,
+                                  zlib.MAX_WBITS | 16)
+
+    return compressor.compress(block) + compressor.flush()
+
+
+class TarStream(object):
+    """Follow a tar stream as it is written, reporting its regular files.
+
+    The listeners' start, data and end methods are called for every file,
+    their other method with all remaining bytes, like headers and padding.
+    Understands ustar headers, GNU long names and pax path records.
+    """
+
+    def __init__(self, listeners):
+        self.listeners = listeners
+        self.header = ""
+        self.member = None
+        self.remaining = 0
+        self.padding = 0
+        self.records = []
+        self.next_path = None
+
+    def feed(self, data):
+        """Process the next piece of the stream."""
+
+        position = 0
+
+        while position < len(data):
+            if self.remaining:
+                chunk = data[position:position + self.remaining]
+                position += len(chunk)
+                self.remaining -= len(chunk)
+
+                if self.member == "file":
+                    self.notify("data", chunk)
+                else:
+                    self.notify("other", chunk)
+                    if self.member is not None:
+                        self.records.append(chunk)
+
+                if not self.remaining:
+                    self.end_member()
+
+            elif self.padding:
+                skipped = min(self.padding, len(data) - position)
+                self.notify("other", data[position:position + skipped])
+                position += skipped
+                self.padding -= skipped
+
+            else:
+                missing = TAR_BLOCK_SIZE - len(self.header)
+                self.header += data[position:position + missing]
+                position += missing
+
+                if len(self.header) == TAR_BLOCK_SIZE:
+                    self.notify("other", self.header)
+                    self.read_header(self.header)
+                    self.header = ""
+
+    def notify(self, method, *arguments):
+        """Call a method of every listener."""
+
+        for listener in self.listeners:
+            getattr(listener, method)(*arguments)
+
+    def read_header(self, header):
+        """Start the member described by a header block."""
+
+        # the end of the archive is marked by empty blocks
+        if header == "\0" * TAR_BLOCK_SIZE:
+            return
+
+        path = header[0:100].split("\0", 1)[0]
+        if header[257:262] == "ustar":
+            prefix = header[345:500].split("\0", 1)[0]
+            if prefix:
+                path = "{}/{}".format(prefix, path)
+
+        if self.next_path is not None:
+            path = self.next_path
+            self.next_path = None
+
+        size = read_size(header[124:136])
+        member_type = header[156]
+
+        self.remaining = size
+        self.padding = -size % TAR_BLOCK_SIZE
+        self.records = []
+
+        if member_type in TAR_FILE_TYPES:
+            self.member = "file"
+            self.notify("start", path, size)
+        elif member_type == "L":
+            self.member = "long name"
+        elif member_type == "x":
+            self.member = "pax"
+        else:
+            self.member = None
+
+        if not size:
+            self.end_member()
+
+    def end_member(self):
+        """Finish the current member once all of its data is read."""
+
+        if self.member == "file":
+            self.notify("end")
+
+        elif self.member == "long name":
+            self.next_path = "".join(self.records).rstrip("\0")
+
+        elif self.member == "pax":
+            path = read_pax_path("".join(self.records))
+            if path is not None:
+                self.next_path = path
+
+        self.member = None
+
+
+def read_size(field):
+    """Read the size field of a tar header, octal or base-256 encoded."""
+
+    if ord(field[0]) & 0x80:
+        size = ord(field[0]) & 0x7f
+        for character in field[1:]:
+            size = size * 256 + ord(character)
+        return size
+
+    return int(field.strip(" \0") or "0", 8)
+
+
+def read_pax_path(records):
+    """Return the path of pax extended header records, if there is one."""
+
+    position = 0
+
+    while position < len(records):
+        length, _, rest = records[position:].partition(" ")
+        if not length.isdigit():
+            break
+
+        key, _, value = rest[:int(length) - len(length) - 2].partition("=")
+        if key == "path":
+            return value
+
+        position += int(length)
+
+    return None
+
+
+class ChecksumPool(object):
+    """Hash the files of a tar stream in a pool of threads.
+
+    Each file is hashed by one thread, the files are handed to the threads
+    in turn. Lines in the format of sha256sum are written to `output` in
+    archive order, with a bounded number of files in flight.
+    """
+
+    def __init__(self, output, workers):
+        self.output = output
+        self.window = workers * 4
+        self.pending = deque()
+        self.queues = []
+        self.threads = []
+        self.turn = 0
+        self.queue = None
+        self.entry = None
+
+        for _ in range(workers):
+            queue = Queue.Queue(maxsize=8)
+            thread = threading.Thread(target=self.work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.queues.append(queue)
+            self.threads.append(thread)
+
+    def start(self, path, size):
+        """Begin a file, handing it to the next thread."""
+
+        self.entry = {"path": path, "digest": None,
+                      "done": threading.Event()}
+        self.queue = self.queues[self.turn % len(self.queues)]
+        self.turn += 1
+        self.pending.append(self.entry)
+
+    def data(self, chunk):
+        """Hash a piece of the current file."""
+
+        self.queue.put((self.entry, chunk))
+
+    def other(self, data):
+        """Headers and padding are not part of any checksum."""
+
+        pass
+
+    def end(self):
+        """Finish the current file, write the lines of finished files."""
+
+        self.queue.put((self.entry, None))
+
+        while self.pending and (self.pending[0]["done"].is_set()
+                                or len(self.pending) > self.window):
+            self.write(self.pending.popleft())
+
+    def write(self, entry):
+        """Write the line of a file once its checksum is known."""
+
+        entry["done"].wait()
+        self.output.write(format_checksum(entry["digest"], entry["path"]))
+
+    def work(self, queue):
+        """Hash the files of a queue until None is queued."""
+
+        checksum = None
+
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+
+            entry, chunk = item
+            if checksum is None:
+                checksum = hashlib.sha256()
+
+            if chunk is None:
+                entry["digest"] = checksum.hexdigest()
+                entry["done"].set()
+                checksum = None
+            else:
+                checksum.update(chunk)
+
+    def close(self):
+        """Wait for the threads and write the remaining lines."""
+
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        while self.pending:
+            self.write(self.pending.popleft())
+
+
+def format_checksum(digest, path):
+    """Format a line of a manifest the way sha256sum does."""
+
+    if "\\" in path or "\n" in path:
+        return "\\{}  {}\n".format(digest, path.replace("\\", "\\\\")
+                                    .replace("\n", "\\n"))
+
+    return "{}  {}\n".format(digest, path)
+
+
+class ManifestCheck(object):
+    """Compare lines of checksums, in order, with those of a manifest."""
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.checked = 0
+        self.problems = []
+
+    def write(self, line):
+        """Compare the next line with the manifest."""
+
+        self.checked += 1
+
+        if line != self.manifest_file.readline():
+            self.problems.append(line.split("  ", 1)[-1].rstrip("\n"))
+
+    def finish(self):
+        """Report files of the manifest which were not in the archive."""
+
+        for line in self.manifest_file:
+            self.problems.append(line.split("  ", 1)[-1].rstrip("\n"))
+
+
+def verify_archive(archive_path, jobs, store=None):
+    """Check the files of an archive against its manifest.
+
+    Given a store, the archive is rebuilt from the index at archive_path.
+    Returns the number of checked files and the paths which differ, are
+    missing or were not expected.
+    """
+
+    decompressor = None
+
+    if store:
+        blocks = store.restore(archive_path)
+    else:
+        if archive_path.endswith(ARCHIVE_SUFFIXES["zstd"]):
+            decompress_command = ["zstd", "-dcq", archive_path]
+        else:
+            decompress_command = ["gzip", "-dc", archive_path]
+
+        decompressor = subprocess.Popen(decompress_command,
+                                        stdout=subprocess.PIPE)
+        blocks = iter(lambda: decompressor.stdout.read(BLOCK_SIZE), "")
+
+    with open(archive_path + MANIFEST_SUFFIX, "r") as manifest_file:
+        check = ManifestCheck(manifest_file)
+        checksums = ChecksumPool(check, jobs)
+        parser = TarStream([checksums])
+
+        for block in blocks:
+            parser.feed(block)
+
+        checksums.close()
+        check.finish()
+
+    if decompressor and decompressor.wait() != 0:
+        raise subprocess.CalledProcessError(decompressor.returncode,
+                                            decompress_command)
+
+    return check.checked, check.problems
+
+
+def verify_home_archive(options, log):
+    """Verify the archive of the specified user against its manifest.
+
+    Raises ArchivalError if it does not match, so the home is kept.
+    """
+
+    archive_path = get_archive_path(options)
+
+    if options.dry_run is True:
+        log.info("Archive {} would be verified here.".format(archive_path))
+        return
+
+    store = ChunkStore(options.store) if options.store else None
+
+    try:
+        checked, problems = verify_archive(archive_path, options.jobs, store)
+
+    except (subprocess.CalledProcessError, EnvironmentError), error:
+        log.error("Could not verify {}. Error was: {}".format(archive_path,
+                                                             error))
+        raise ArchivalError("Could not verify {}.".format(archive_path))
+
+    if problems:
+        log.error("Archive {} does not match its manifest in {} files, "
+                  "e.g. {}".format(archive_path, len(problems),
+                                   ", ".join(problems[:10])))
+        raise ArchivalError("Archive {} does not match its manifest.".format(
+            archive_path))
+
+    log.info("Verified {} files in {}.".format(checked, archive_path))
+
+
+class ChunkStore(object):
+    """Compressed chunks of file data, named by their SHA-256.
+
+    Shared by the archives of all users, every chunk is kept only once.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def chunk_path(self, digest):
+        """Return the path of a chunk."""
+
+        return os.path.join(self.root, "chunks", digest[:2], digest[2:])
+
+    def restore(self, index_path):
+        """Yield the pieces of the tar stream recorded in an index."""
+
+        with gzip.open(index_path, "rb") as index_file:
+            for line in iter(index_file.readline, ""):
+                kind, _, rest = line.rstrip("\n").partition(" ")
+
+                if kind == "L":
+                    yield index_file.read(int(rest))
+
+                elif kind == "C":
+                    digest, size = rest.split(" ")
+                    with open(self.chunk_path(digest), "rb") as chunk_file:
+                        try:
+                            data = zlib.decompress(chunk_file.read())
+                        except zlib.error:
+                            data = None
+                    if data is None or len(data) != int(size):
+                        raise IOError("Chunk {} is damaged.".format(digest))
+                    yield data
+
+                else:
+                    raise IOError("{} is not a store index.".format(
+                        index_path))
+
+
+class StoreWriter(object):
+    """Keep a tar stream in a chunk store and an index to rebuild it from.
+
+    Data of files from INLINE_SIZE on is cut into chunks, each of which is
+    compressed into the store by a pool of processes unless it is there
+    already. Everything else, like headers and small files, is kept in the
+    gzipped index, which lists literal pieces and chunks in stream order.
+    """
+
+    def __init__(self, store, index_path, jobs):
+        self.store = store
+        self.index = gzip.open(index_path, "wb")
+        self.literal = []
+        self.literal_size = 0
+        self.buffer = []
+        self.buffer_size = 0
+        self.chunked = False
+        self.queued = set()
+        self.window = jobs * 2
+        self.pending = deque()
+        self.pool = None
+
+        if jobs > 1:
+            self.pool = multiprocessing.Pool(jobs)
+
+    def start(self, path, size):
+        """Begin a file, to be chunked if it is large enough."""
+
+        self.chunked = size >= INLINE_SIZE
+
+    def data(self, chunk):
+        """Add a piece of the current file."""
+
+        if not self.chunked:
+            self.other(chunk)
+            return
+
+        self.buffer.append(chunk)
+        self.buffer_size += len(chunk)
+
+        if self.buffer_size >= CHUNK_SIZE:
+            data = "".join(self.buffer)
+            while len(data) >= CHUNK_SIZE:
+                self.write_chunk(data[:CHUNK_SIZE])
+                data = data[CHUNK_SIZE:]
+            self.buffer = [data]
+            self.buffer_size = len(data)
+
+    def end(self):
+        """Store the rest of the current file."""
+
+        if self.chunked and self.buffer_size:
+            self.write_chunk("".join(self.buffer))
+
+        self.buffer = []
+        self.buffer_size = 0
+        self.chunked = False
+
+    def other(self, data):
+        """Keep bytes in the index."""
+
+        self.literal.append(data)
+        self.literal_size += len(data)
+
+        if self.literal_size >= CHUNK_SIZE:
+            self.write_literal()
+
+    def write_literal(self):
+        """Write the bytes kept so far into the index."""
+
+        if self.literal_size:
+            self.index.write("L {}\n".format(self.literal_size))
+            self.index.write("".join(self.literal))
+
+        self.literal = []
+        self.literal_size = 0
+
+    def write_chunk(self, data):
+        """Reference a chunk in the index, store it if it is new."""
+
+        self.write_literal()
+
+        digest = hashlib.sha256(data).hexdigest()
+        self.index.write("C {} {}\n".format(digest, len(data)))
+
+        path = self.store.chunk_path(digest)
+        if digest in self.queued or os.path.exists(path):
+            return
+        self.queued.add(digest)
+
+        if self.pool is None:
+            store_chunk(path, data)
+            return
+
+        self.pending.append(self.pool.apply_async(store_chunk, (path, data)))
+
+        while self.pending and (len(self.pending) >= self.window
+                                or self.pending[0].ready()):
+            self.pending.popleft().get()
+
+    def close(self):
+        """Write the rest of the index, wait for the chunks to be stored."""
+
+        self.write_literal()
+
+        while self.pending:
+            self.pending.popleft().get()
+
+        self.index.close()
+
+    def terminate(self):
+        """Stop the pool, also after a failure."""
+
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+        self.index.close()
+
+
+def store_chunk(path, data):
+    """Compress a chunk into its file in the store.
+
+    Other users of a batch may store the same chunk at the same time, a
+    chunk which is already there counts as stored.
+    """
+
+    if os.path.exists(path):
+        return
+
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        # another process may have created it in the meantime
+        if not os.path.isdir(directory):
+            raise
+
+    # renamed into place once complete, each writer has a file of its own
+    handle, partial_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+    try:
+        with os.fdopen(handle, "wb") as chunk_file:
+            chunk_file.write(zlib.compress(data, COMPRESSION_LEVEL))
+
+        os.rename(partial_path, path)
+
+    except EnvironmentError:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        if not os.path.exists(path):
+            raise
+
+
+def restore_home(options):
+    """Write the archive of options.user, rebuilt from the store, to stdout."""
+
+    store = ChunkStore(options.store)
+
+    try:
+        for data in store.restore(get_archive_path(options)):
+            sys.stdout.write(data)
+    except EnvironmentError, error:
+        sys.exit("Could not restore archive. Error was: {}".format(error))
 
 
 def trash_home(options, log):
-    """Move the specified user's home directory into the trash."""
+    """Move the specified user's home directory into the trash.
+
+    Raises ArchivalError if that fails.
+    """
 
     if sys.platform == "darwin":
         trash_alias = "trash"
@@ -144,10 +1142,10 @@ def trash_home(options, log):
         try:
             subprocess.check_output(trash_command)
             log.info("Moved home of {} to trash.".format(options.user))
-        except subprocess.CalledProcessError:
+        except (subprocess.CalledProcessError, OSError):
             log.error("Moving home of {} to trash failed.".format(
                 options.user))
-            sys.exit("Aborted.")
+            raise ArchivalError("Aborted.")
 
 
 if __name__ == "__main__":
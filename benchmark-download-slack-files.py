@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+# Allow CAPS in function names
+# pylint: disable=C0103
+
+"""
+Benchmark download-slack-files against a local stand-in file host.
+
+The export benchmark generates a synthetic Slack export, serves its
+attachments locally and runs the downloader on it end to end, reporting
+files/s, MB/s and the downloader's peak memory.
+The keep-alive benchmark measures how many requests per second a single
+worker completes when every file opens a new connection compared to reusing
+kept-alive connections.
+
+Expects download-slack-files.py to be located next to this script.
+"""
+
+import argparse
+import BaseHTTPServer
+import imp
+import json
+import multiprocessing
+import os
+import os.path
+import random
+import resource
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import zipfile
+
+
+DOWNLOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "download-slack-files.py")
+# the downloader's default, in seconds
+TIMEOUT = 60.0
+
+
+def load_downloader():
+    """Import download-slack-files.py, which is not a valid module name."""
+
+    return imp.load_source("download_slack_files", DOWNLOADER)
+
+
+class FileHostHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve a body of the requested size, e.g. GET /F123/4096."""
+
+    protocol_version = "HTTP/1.1"
+    # send headers and body in as few packets as possible
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def do_GET(self):
+        """Answer with as many bytes as the last path segment asks for."""
+
+        size = int(self.path.rstrip("/").rsplit("/", 1)[-1])
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+
+        block = "x" * min(size, 64 * 1024)
+        while size > 0:
+            self.wfile.write(block[:size])
+            size -= len(block)
+
+    def log_message(self, *args):
+        """Keep the benchmark output readable."""
+
+        pass
+
+
+class FileHost(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP/1.1 server standing in for Slack's file host."""
+
+    daemon_threads = True
+
+
+def start_file_host():
+    """Serve files on a free local port in a background thread."""
+
+    server = FileHost(("127.0.0.1", 0), FileHostHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+def start_file_host_process():
+    """Serve files from a separate process, return it and its port.
+
+    Keeps the server out of the memory measured for the downloader.
+    """
+
+    server = FileHost(("127.0.0.1", 0), FileHostHandler)
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.daemon = True
+    process.start()
+    server.server_close()
+
+    return process, server.server_address[1]
+
+
+def parse_size_distribution(text):
+    """Parse "SIZE:WEIGHT,..." into a list of (size, weight) pairs."""
+
+    distribution = []
+
+    try:
+        for item in text.split(","):
+            size, _, weight = item.partition(":")
+            distribution.append((int(size), float(weight or 1)))
+    except ValueError:
+        sys.exit("Error: {} is not a valid size distribution".format(text))
+
+    return distribution
+
+
+def pick_size(distribution):
+    """Draw an attachment size from a weighted distribution."""
+
+    point = random.uniform(0, sum(weight for _, weight in distribution))
+
+    for size, weight in distribution:
+        point -= weight
+        if point <= 0:
+            return size
+
+    return distribution[-1][0]
+
+
+def generate_export(directory, port, options):
+    """Write a synthetic Slack export, return the number of files and bytes.
+
+    Every channel gets one JSON file per day, a share of whose messages
+    announce an attachment served by the local file host.
+    """
+
+    distribution = parse_size_distribution(options.sizes)
+    files = 0
+    total_size = 0
+
+    with open(os.path.join(directory, "channels.json"), "w") as json_file:
+        json.dump([], json_file)
+
+    for channel in range(options.channels):
+        channel_directory = os.path.join(directory,
+                                         "channel-{}".format(channel))
+        os.mkdir(channel_directory)
+
+        for day in range(options.days):
+            messages = []
+
+            for number in range(options.messages):
+                message = {"type": "message", "user": "U0",
+                           "ts": "{}.{:06d}".format(day * 86400, number),
+                           "text": "message {}".format(number)}
+
+                if random.random() < options.share_ratio:
+                    size = pick_size(distribution)
+                    file_id = "F{:08d}".format(files)
+                    message["subtype"] = "file_share"
+                    message["file"] = {
+                        "id": file_id,
+                        "name": "{}.bin".format(file_id),
+                        "size": size,
+                        "url_download": "http://127.0.0.1:{}/{}/{}".format(
+                            port, file_id, size)}
+                    files += 1
+                    total_size += size
+
+                messages.append(message)
+
+            day_path = os.path.join(channel_directory,
+                                    "2016-01-{:02d}.json".format(day + 1))
+            with open(day_path, "w") as json_file:
+                json.dump(messages, json_file)
+
+    return files, total_size
+
+
+def zip_export(directory):
+    """Pack an export folder the way Slack ships it, return the zip path."""
+
+    path = "{}.zip".format(directory)
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                file_path = os.path.join(root, name)
+                archive.write(file_path, os.path.relpath(file_path, directory))
+
+    shutil.rmtree(directory)
+
+    return path
+
+
+def benchmark_export(options):
+    """Run the downloader end to end against a synthetic export."""
+
+    random.seed(options.seed)
+    process, port = start_file_host_process()
+    workspace = tempfile.mkdtemp(prefix="slack-benchmark-")
+
+    try:
+        export = os.path.join(workspace, "export")
+        os.mkdir(export)
+        files, total_size = generate_export(export, port, options)
+
+        if options.zip:
+            export = zip_export(export)
+
+        summary_path = os.path.join(workspace, "summary.json")
+        command = [sys.executable, DOWNLOADER, "--workers",
+                   str(options.workers), "--summary", summary_path, export]
+
+        start = time.time()
+        subprocess.check_call(command)
+        elapsed = time.time() - start
+
+        # kilobytes on Linux, bytes on OS X
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if sys.platform != "darwin":
+            peak *= 1024
+
+        with open(summary_path, "r") as summary_file:
+            summary = json.load(summary_file)
+
+    finally:
+        process.terminate()
+        shutil.rmtree(workspace)
+
+    print "files:      {} announced, {} downloaded, {} failed".format(
+        files, summary["files"], summary["failed"])
+    print "size:       {:.1f} MB".format(total_size / 1000.0 ** 2)
+    print "wall time:  {:.2f} s".format(elapsed)
+    print "files/s:    {:.1f}".format(summary["files"] / elapsed)
+    print "MB/s:       {:.1f}".format(summary["bytes"] / elapsed / 1000 ** 2)
+    print "peak RSS:   {:.1f} MB".format(peak / 1000.0 ** 2)
+
+
+def fetch_with_urlopen(downloader, URL, connections):
+    """Fetch like the downloader used to, one connection per file."""
+
+    response = urllib2.urlopen(URL)
+    response.read()
+    response.close()
+
+
+def fetch_without_reuse(downloader, URL, connections):
+    """Fetch through the connection pool, but discard it after each file."""
+
+    downloader.open_URL(URL, connections, TIMEOUT).read()
+    downloader.close_connections(connections)
+
+
+def fetch_with_reuse(downloader, URL, connections):
+    """Fetch through a connection pool kept across files."""
+
+    downloader.open_URL(URL, connections, TIMEOUT).read()
+
+
+def measure(fetch, downloader, URL, requests):
+    """Return the requests per second achieved by `fetch`."""
+
+    connections = {}
+    start = time.time()
+
+    for _ in range(requests):
+        fetch(downloader, URL, connections)
+
+    elapsed = time.time() - start
+    downloader.close_connections(connections)
+
+    return requests / elapsed
+
+
+def benchmark_keep_alive(options):
+    """Compare requests per second with and without connection reuse."""
+
+    downloader = load_downloader()
+    server = start_file_host()
+    URL = "http://127.0.0.1:{}/F0/{}".format(server.server_address[1],
+                                             options.size)
+
+    candidates = [("urlopen", fetch_with_urlopen),
+                  ("no reuse", fetch_without_reuse),
+                  ("keep-alive", fetch_with_reuse)]
+
+    for name, fetch in candidates:
+        rate = measure(fetch, downloader, URL, options.requests)
+        print "{:<12} {:>10.1f} requests/s".format(name, rate)
+
+    server.shutdown()
+
+
+def parse_arguments():
+    """Parse given command line arguments."""
+
+    text_mode = ("run the downloader on a synthetic export or compare "
+                 "connection reuse (default: export)")
+    text_channels = "channels in the synthetic export (default: 20)"
+    text_days = "days of messages per channel (default: 10)"
+    text_messages = "messages per channel and day (default: 50)"
+    text_share_ratio = "share of messages with an attachment (default: 0.2)"
+    text_sizes = ("attachment sizes in bytes and their weights "
+                  "(default: 4096:70,262144:25,8388608:5)")
+    text_workers = "concurrent downloads (default: 8)"
+    text_zip = "hand the export to the downloader as zip file"
+    text_seed = "seed for the synthetic export (default: 0)"
+    text_requests = ("keep-alive: files fetched per variant "
+                     "(default: 2000)")
+    text_size = "keep-alive: size of each served file in bytes (default: 4096)"
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("mode", help=text_mode, nargs="?", default="export",
+                        choices=["export", "keep-alive"])
+    parser.add_argument("--channels", help=text_channels, type=int,
+                        default=20)
+    parser.add_argument("--days", help=text_days, type=int, default=10)
+    parser.add_argument("--messages", help=text_messages, type=int,
+                        default=50)
+    parser.add_argument("--share-ratio", help=text_share_ratio, type=float,
+                        default=0.2)
+    parser.add_argument("--sizes", help=text_sizes,
+                        default="4096:70,262144:25,8388608:5")
+    parser.add_argument("-w", "--workers", help=text_workers, type=int,
+                        default=8)
+    parser.add_argument("--zip", help=text_zip, action="store_true")
+    parser.add_argument("--seed", help=text_seed, type=int, default=0)
+    parser.add_argument("-n", "--requests", help=text_requests, type=int,
+                        default=2000)
+    parser.add_argument("-s", "--size", help=text_size, type=int,
+                        default=4096)
+
+    arguments = parser.parse_args()
+    return arguments
+
+
+def main():
+    """Benchmark download-slack-files against a local stand-in file host."""
+
+    options = parse_arguments()
+
+    if options.mode == "keep-alive":
+        benchmark_keep_alive(options)
+    else:
+        benchmark_export(options)
+
+if __name__ == "__main__":
+    main()
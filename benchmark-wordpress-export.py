@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+# Allow CAPS in function names
+# pylint: disable=C0103
+
+"""
+Benchmark extract-content-from-wordpress-mysql on a synthetic WordPress.
+
+The export benchmark generates an SQLite database with the WordPress tables
+the exporter reads, filled with a configurable number of posts, pages,
+authors and labels, then runs the exporter on it and reports posts/s and its
+peak memory.
+The render benchmark measures the cost of rendering a single post across
+content sizes, compared to rendering by repeated string concatenation.
+
+Expects extract-content-from-wordpress-mysql.py next to this script.
+"""
+
+import argparse
+import imp
+import os
+import os.path
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+
+EXPORTER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "extract-content-from-wordpress-mysql.py")
+
+SCHEMA = """
+CREATE TABLE {0}_users (
+    ID INTEGER PRIMARY KEY, user_login TEXT, user_pass TEXT,
+    user_nicename TEXT, user_email TEXT, user_url TEXT,
+    user_registered TEXT, user_activation_key TEXT, user_status INTEGER,
+    display_name TEXT);
+CREATE TABLE {0}_posts (
+    ID INTEGER PRIMARY KEY, post_author INTEGER, post_date TEXT,
+    post_date_gmt TEXT, post_content TEXT, post_title TEXT,
+    post_excerpt TEXT, post_status TEXT, comment_status TEXT,
+    ping_status TEXT, post_password TEXT, post_name TEXT, to_ping TEXT,
+    pinged TEXT, post_modified TEXT, post_modified_gmt TEXT,
+    post_content_filtered TEXT, post_parent INTEGER, guid TEXT,
+    menu_order INTEGER, post_type TEXT, post_mime_type TEXT,
+    comment_count INTEGER);
+CREATE INDEX {0}_type_status_date ON {0}_posts (post_type, post_status,
+                                                  post_date, ID);
+CREATE TABLE {0}_terms (
+    term_id INTEGER PRIMARY KEY, name TEXT, slug TEXT, term_group INTEGER);
+CREATE TABLE {0}_term_taxonomy (
+    term_taxonomy_id INTEGER PRIMARY KEY, term_id INTEGER, taxonomy TEXT,
+    description TEXT, parent INTEGER, count INTEGER);
+CREATE TABLE {0}_term_relationships (
+    object_id INTEGER, term_taxonomy_id INTEGER, term_order INTEGER,
+    PRIMARY KEY (object_id, term_taxonomy_id));
+"""
+
+CONTENT_SIZES = (1024, 16 * 1024, 256 * 1024, 1024 * 1024)
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+def load_exporter():
+    """Import the exporter, whose file name is not a valid module name."""
+
+    return imp.load_source("extract_content_from_wordpress_mysql", EXPORTER)
+
+
+def make_text(generator, size):
+    """Return roughly `size` bytes of paragraphs of filler words."""
+
+    words = []
+    length = 0
+
+    while length < size:
+        word = generator.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+
+        if generator.random() < 0.02:
+            words.append("\n\n")
+
+    return " ".join(words)[:size]
+
+
+def make_date(generator):
+    """Return a random MySQL style date between 2005 and 2016."""
+
+    return "{}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(
+        generator.randint(2005, 2016), generator.randint(1, 12),
+        generator.randint(1, 28), generator.randint(0, 23),
+        generator.randint(0, 59), generator.randint(0, 59))
+
+
+def create_database(path, options):
+    """Fill an SQLite file with a synthetic WordPress installation."""
+
+    generator = random.Random(options.seed)
+    connection = sqlite3.connect(path)
+    prefix = options.prefix
+
+    connection.executescript(SCHEMA.format(prefix))
+
+    connection.executemany(
+        "INSERT INTO {}_users (ID, user_login, display_name) "
+        "VALUES (?, ?, ?)".format(prefix),
+        [(number, "author{}".format(number), "Author {}".format(number))
+         for number in range(1, options.authors + 1)])
+
+    # term_taxonomy_id deliberately differs from term_id, as it often does
+    connection.executemany(
+        "INSERT INTO {}_terms (term_id, name, slug, term_group) "
+        "VALUES (?, ?, ?, 0)".format(prefix),
+        [(number, "Label {}".format(number), "label-{}".format(number))
+         for number in range(1, options.terms + 1)])
+    connection.executemany(
+        "INSERT INTO {}_term_taxonomy (term_taxonomy_id, term_id, taxonomy, "
+        "description, parent, count) VALUES (?, ?, ?, '', 0, 0)".format(
+            prefix),
+        [(number + 1000, number,
+          "category" if number % 10 == 0 else "post_tag")
+         for number in range(1, options.terms + 1)])
+
+    total = options.posts + options.pages
+
+    for start in range(1, total + 1, 1000):
+        posts = []
+        relationships = []
+
+        for ID in range(start, min(start + 1000, total + 1)):
+            post_type = "post" if ID <= options.posts else "page"
+            status = ("auto-draft" if generator.random() < 0.01
+                      else "publish")
+            date = make_date(generator)
+
+            posts.append((ID, generator.randint(1, options.authors), date,
+                          make_text(generator, options.content_size),
+                          "Post number {}".format(ID), status,
+                          "post-number-{}".format(ID), date, "",
+                          "http://example.com/?p={}".format(ID), post_type))
+
+            terms = generator.sample(range(1, options.terms + 1),
+                                     min(options.labels, options.terms))
+            for order, term in enumerate(terms):
+                relationships.append((ID, term + 1000, order))
+
+        connection.executemany(
+            "INSERT INTO {}_posts (ID, post_author, post_date, post_content, "
+            "post_title, post_status, post_name, post_modified, "
+            "post_content_filtered, guid, post_type) VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)".format(prefix), posts)
+        connection.executemany(
+            "INSERT INTO {}_term_relationships (object_id, term_taxonomy_id, "
+            "term_order) VALUES (?, ?, ?)".format(prefix), relationships)
+
+    connection.commit()
+    connection.close()
+
+
+def benchmark_export(database, options):
+    """Run the exporter on the database, print its throughput and memory."""
+
+    output = tempfile.mkdtemp(prefix="wordpress-benchmark-")
+    command = [sys.executable, EXPORTER, "--sqlite", database, "--prefix",
+               options.prefix, "--include-categories", "--include-tags",
+               "--include-author"]
+
+    if options.pipeline:
+        command.append("--pipeline")
+    if options.stream:
+        command.extend(["--stream", str(options.stream)])
+
+    try:
+        start = time.time()
+        subprocess.check_call(command, cwd=output)
+        elapsed = time.time() - start
+
+        exported = 0
+        for _, _, files in os.walk(output):
+            exported += len(files)
+
+    finally:
+        shutil.rmtree(output)
+
+    # kilobytes on Linux, bytes on OS X
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024
+
+    print "exported:   {} files".format(exported)
+    print "wall time:  {:.2f} s".format(elapsed)
+    print "posts/s:    {:.1f}".format(exported / elapsed)
+    print "peak RSS:   {:.1f} MB".format(peak / 1000.0 ** 2)
+
+
+def build_export_concatenating(entry, options, authors=None, tags=None,
+                               categories=None):
+    """Render like the exporter used to, concatenating piece by piece."""
+
+    export = "Title: {}\n".format(entry["post_title"])
+    export = export + "Date: {}\n".format(entry["post_date"])
+
+    if tags:
+        tags_string = ""
+        for tag in tags:
+            tags_string = tags_string + tag + ","
+        export = export + "Tags: {}\n".format(tags_string)
+
+    if categories:
+        category_string = ""
+        for category in categories:
+            category_string = category_string + category + ","
+        export = export + "Categories: {}\n".format(category_string)
+
+    if authors:
+        export = export + "Authors: {}\n".format(authors[entry["post_author"]])
+
+    if options.include_modified_date:
+        export = export + "Modified: {}\n".format(entry["post_modified"])
+    if options.include_published_url:
+        export = export + "Permalink: {}\n".format(entry["guid"])
+
+    if entry["post_content_filtered"] == "":
+        export = export + "\n{}\n".format(entry["post_content"])
+    else:
+        export = export + "\n{}\n".format(entry["post_content_filtered"])
+
+    return export
+
+
+def measure_render(build, arguments, repetitions):
+    """Return the microseconds `build` takes to render one post."""
+
+    start = time.time()
+
+    for _ in range(repetitions):
+        build(*arguments)
+
+    return (time.time() - start) / repetitions * 1000 ** 2
+
+
+def benchmark_render(options):
+    """Compare the per-post render cost across content sizes."""
+
+    exporter = load_exporter()
+    generator = random.Random(options.seed)
+    # every metadata line of the export is included
+    render_options = argparse.Namespace(include_modified_date=True,
+                                        include_published_url=True)
+    labels = ["Label {}".format(number) for number in range(options.labels)]
+
+    print "{:>10} {:>14} {:>14}".format("content", "join", "concatenate")
+
+    for size in CONTENT_SIZES:
+        date = make_date(generator)
+        entry = {"ID": 1, "post_author": 1, "post_date": date,
+                 "post_title": "Post number 1", "post_name": "post-number-1",
+                 "post_modified": date, "guid": "http://example.com/?p=1",
+                 "post_content": make_text(generator, size),
+                 "post_content_filtered": ""}
+        arguments = (entry, render_options, {1: "Author 1"}, labels, labels)
+        # render about the same amount of text for every size
+        repetitions = max(10, options.render_bytes // size)
+
+        joined = measure_render(exporter.build_export, arguments, repetitions)
+        concatenated = measure_render(build_export_concatenating, arguments,
+                                      repetitions)
+
+        print "{:>8} B {:>11.1f} us {:>11.1f} us".format(size, joined,
+                                                        concatenated)
+
+
+def parse_arguments():
+    """Parse given command line arguments."""
+
+    text_mode = ("run the exporter on a synthetic database or measure "
+                 "rendering single posts (default: export)")
+    text_posts = "number of posts (default: 10000)"
+    text_pages = "number of pages (default: 100)"
+    text_authors = "number of authors (default: 10)"
+    text_terms = "number of tags and categories (default: 500)"
+    text_labels = "labels per post or page (default: 8)"
+    text_content_size = "bytes of content per post or page (default: 4096)"
+    text_prefix = "Prefix of the WordPress tables (default: wp)"
+    text_seed = "seed for the synthetic content (default: 0)"
+    text_database = ("keep the generated SQLite database in this file, or "
+                     "reuse it if it exists")
+    text_pipeline = "let the exporter fetch, render and write in a pipeline"
+    text_stream = "let the exporter stream rows in batches of this size"
+    text_render_bytes = ("render: content rendered per size and variant in "
+                         "bytes (default: 256000000)")
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("mode", help=text_mode, nargs="?", default="export",
+                        choices=["export", "render"])
+    parser.add_argument("--posts", help=text_posts, type=int, default=10000)
+    parser.add_argument("--pages", help=text_pages, type=int, default=100)
+    parser.add_argument("--authors", help=text_authors, type=int, default=10)
+    parser.add_argument("--terms", help=text_terms, type=int, default=500)
+    parser.add_argument("--labels", help=text_labels, type=int, default=8)
+    parser.add_argument("--content-size", help=text_content_size, type=int,
+                        default=4096)
+    parser.add_argument("-p", "--prefix", help=text_prefix, default="wp")
+    parser.add_argument("--seed", help=text_seed, type=int, default=0)
+    parser.add_argument("--database", help=text_database, metavar="FILE")
+    parser.add_argument("--pipeline", help=text_pipeline,
+                        action="store_true")
+    parser.add_argument("--stream", help=text_stream, type=int,
+                        metavar="BATCH_SIZE")
+    parser.add_argument("--render-bytes", help=text_render_bytes, type=int,
+                        default=256 * 1000 ** 2)
+
+    arguments = parser.parse_args()
+
+    if arguments.authors < 1 or arguments.terms < 1:
+        parser.error("at least one author and one term are required")
+
+    return arguments
+
+
+def main():
+    """Benchmark the WordPress exporter on a synthetic installation."""
+
+    options = parse_arguments()
+
+    if options.mode == "render":
+        benchmark_render(options)
+        return
+
+    workspace = tempfile.mkdtemp(prefix="wordpress-database-")
+    database = options.database or os.path.join(workspace, "wordpress.db")
+
+    try:
+        if not os.path.exists(database):
+            start = time.time()
+            create_database(database, options)
+            print "generated:  {} in {:.2f} s".format(database,
+                                                      time.time() - start)
+
+        benchmark_export(database, options)
+
+    finally:
+        shutil.rmtree(workspace)
+
+if __name__ == "__main__":
+    main()
@@ -6,18 +6,460 @@
 """
 Download all files linked in a Slack export archive.
 
+The export can be given as unzipped folder or as the zip file itself, in which
+case the channel folders are created next to it.
 All uploaded files are downloaded into their respective channel folders.
 Optionally, Slack IDs can be used instead of file names.
 
+Completed downloads are recorded in a manifest at the root of the export, so
+later runs skip them and continue interrupted downloads where they stopped.
+Files shared into several channels can be downloaded once into a
+content-addressed store and linked into every channel folder.
+Requests can be rate limited across all workers, throttling slows them down
+and failed downloads are retried.
+Progress is shown while downloading and a summary can be written at the end.
 """
 
 import argparse
-from functools import partial
+from collections import deque, namedtuple
+import hashlib
+import httplib
 import json
+import os
 import os.path
-from multiprocessing import Pool
+import Queue
+import random
+import re
+import socket
+import threading
+import time
 import urllib2
+import urlparse
 import sys
+import zipfile
+
+
+# a single file to fetch: the channel folder, local file name, source URL and
+# the Slack file ID and size it was announced with
+Job = namedtuple("Job", ["directory", "filename", "URL", "file_id", "size"])
+
+# state shared by all download workers
+Session = namedtuple("Session", ["options", "manifest", "store", "limiter",
+                                 "progress"])
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MANIFEST_NAME = "download-manifest.jsonl"
+STORE_NAME = ".file-store"
+# longest pause between two attempts of the same file, in seconds
+MAXIMUM_BACKOFF = 60.0
+# "bytes 100-199/1000" of a partial answer or "bytes */1000" of a 416
+CONTENT_RANGE = re.compile(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)")
+# upper bounds of the file size buckets in the summary, in bytes
+SIZE_BUCKETS = [(64 * 1024, "<64KiB"), (1024 ** 2, "<1MiB"),
+                (16 * 1024 ** 2, "<16MiB"), (256 * 1024 ** 2, "<256MiB"),
+                (None, ">=256MiB")]
+
+
+class Manifest(object):
+    """Append-only JSON Lines record of completed downloads.
+
+    Every line holds the path relative to the export root, the Slack file ID,
+    the size and the SHA-1 checksum of one finished file. Later lines win.
+    """
+
+    def __init__(self, root_directory):
+        self.root_directory = root_directory
+        self.path = os.path.join(root_directory, MANIFEST_NAME)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as manifest_file:
+                for line in manifest_file:
+                    try:
+                        entry = json.loads(line)
+                    # a crash may have left a truncated last line
+                    except ValueError:
+                        continue
+                    self.entries[entry["path"]] = entry
+
+        self.manifest_file = open(self.path, "a")
+
+    def key(self, job):
+        """Return the manifest key of a job."""
+
+        path = os.path.join(job.directory, job.filename)
+        return os.path.relpath(path, self.root_directory)
+
+    def completed(self, job):
+        """Tell whether the job's file is already downloaded and intact.
+
+        A file is only intact with the size Slack announced for it, where
+        Slack gave one.
+        """
+
+        entry = self.entries.get(self.key(job))
+        path = os.path.join(job.directory, job.filename)
+
+        return (entry is not None
+                and entry.get("id") == job.file_id
+                and (not job.size or entry.get("size") == job.size)
+                and os.path.isfile(path)
+                and os.path.getsize(path) == entry.get("size"))
+
+    def record(self, job, size, checksum):
+        """Add a finished download to the manifest."""
+
+        entry = {"path": self.key(job), "id": job.file_id, "size": size,
+                 "sha1": checksum}
+
+        with self.lock:
+            self.entries[entry["path"]] = entry
+            self.manifest_file.write(json.dumps(entry) + "\n")
+            self.manifest_file.flush()
+
+    def checksums(self):
+        """Return a dictionary of Slack file IDs to recorded checksums."""
+
+        with self.lock:
+            return dict((entry["id"], entry["sha1"])
+                        for entry in self.entries.values())
+
+    def close(self):
+        """Close the manifest file."""
+
+        self.manifest_file.close()
+
+
+class RateLimiter(object):
+    """Token bucket shared by all workers, adapting to throttling.
+
+    When the file host answers with 429 all workers pause for the requested
+    time and the rate is halved. Every successful download raises it again
+    until the configured rate is reached. Without a configured rate requests
+    are only limited after a 429, starting from the rate of the last second,
+    until that rate is reached again.
+    """
+
+    def __init__(self, rate):
+        self.maximum_rate = rate
+        self.limit = rate
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.paused_until = 0.0
+        # times of the requests of the last second while unlimited
+        self.recent = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until the next request may be sent."""
+
+        while True:
+            with self.lock:
+                now = time.time()
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif not self.rate:
+                    self.recent.append(now)
+                    while self.recent[0] < now - 1.0:
+                        self.recent.popleft()
+                    return
+                else:
+                    elapsed = now - self.updated
+                    self.tokens = min(self.capacity,
+                                      self.tokens + elapsed * self.rate)
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def throttled(self, pause):
+        """Slow down after the server asked us to."""
+
+        with self.lock:
+            if not self.rate:
+                self.limit = max(1.0, float(len(self.recent)))
+                self.rate = self.limit
+                self.capacity = self.limit
+                self.recent.clear()
+
+            self.rate = max(self.limit / 64, self.rate / 2)
+            self.tokens = 0.0
+            self.updated = time.time()
+            self.paused_until = max(self.paused_until, self.updated + pause)
+
+    def succeeded(self):
+        """Speed up again after a successful download."""
+
+        with self.lock:
+            if not self.rate:
+                return
+
+            self.rate = min(self.limit, self.rate + self.limit / 100)
+
+            # back to unlimited, until the server objects again
+            if not self.maximum_rate and self.rate >= self.limit:
+                self.rate = 0.0
+
+
+class Progress(object):
+    """Counters of all download workers, for the live view and the summary."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.total = 0
+        self.skipped = 0
+        self.done = 0
+        self.failed = 0
+        self.retries = 0
+        self.bytes = 0
+        self.in_flight = {}
+        self.latencies = []
+
+    def queued(self):
+        """Count a file scheduled for download."""
+
+        with self.lock:
+            self.total += 1
+
+    def already_done(self):
+        """Count a file which was downloaded by an earlier run."""
+
+        with self.lock:
+            self.skipped += 1
+
+    def started(self, job):
+        """Note the file the calling worker is downloading now."""
+
+        with self.lock:
+            self.in_flight[threading.current_thread().name] = [job, 0]
+
+    def transferred(self, size):
+        """Count bytes received by the calling worker."""
+
+        with self.lock:
+            self.bytes += size
+            self.in_flight[threading.current_thread().name][1] += size
+
+    def retried(self):
+        """Count a failed attempt which is going to be retried."""
+
+        with self.lock:
+            self.retries += 1
+
+    def finished(self, size, seconds):
+        """Count a completed download and how long its transfer took."""
+
+        with self.lock:
+            self.done += 1
+            self.latencies.append((size, seconds))
+
+    def abandoned(self):
+        """Count a file which failed without a worker of its own."""
+
+        with self.lock:
+            self.failed += 1
+
+    def stopped(self, error=None):
+        """Note the calling worker is done with its file."""
+
+        with self.lock:
+            if error is not None:
+                self.failed += 1
+            self.in_flight.pop(threading.current_thread().name, None)
+
+    def status(self, width=160):
+        """Return a one line overview of the running downloads."""
+
+        with self.lock:
+            elapsed = max(time.time() - self.start, 0.001)
+            line = "{}/{} files, {:.1f} MB/s, {} errors, {} in flight".format(
+                self.done, self.total, self.bytes / elapsed / 1000 ** 2,
+                self.failed, len(self.in_flight))
+
+            files = []
+            for name in sorted(self.in_flight):
+                job, received = self.in_flight[name]
+                if job.size:
+                    files.append("{} {:.0%}".format(
+                        job.filename, float(received) / job.size))
+                else:
+                    files.append("{} {}B".format(job.filename, received))
+
+        if files:
+            line = "{}: {}".format(line, ", ".join(files))
+
+        return line[:width]
+
+    def summary(self, workers):
+        """Return a machine-readable summary of the run."""
+
+        with self.lock:
+            elapsed = max(time.time() - self.start, 0.001)
+            buckets = {}
+
+            for size, seconds in self.latencies:
+                for limit, name in SIZE_BUCKETS:
+                    if limit is None or size < limit:
+                        buckets.setdefault(name, []).append(seconds)
+                        break
+
+            latency = {}
+            for name, seconds in buckets.items():
+                seconds.sort()
+                latency[name] = {"files": len(seconds),
+                                 "p50": get_percentile(seconds, 50),
+                                 "p90": get_percentile(seconds, 90),
+                                 "p99": get_percentile(seconds, 99),
+                                 "max": seconds[-1]}
+
+            return {"workers": workers,
+                    "seconds": elapsed,
+                    "files": self.done,
+                    "failed": self.failed,
+                    "skipped": self.skipped,
+                    "retries": self.retries,
+                    "bytes": self.bytes,
+                    "files_per_second": self.done / elapsed,
+                    "bytes_per_second": self.bytes / elapsed,
+                    "latency_seconds": latency}
+
+
+def get_percentile(ordered, percent):
+    """Return the nearest-rank percentile of an ordered, non-empty list."""
+
+    rank = int(round(percent / 100.0 * len(ordered) + 0.5))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def show_progress(progress, stop):
+    """Redraw the progress line on stderr every second until stopped."""
+
+    while not stop.wait(1.0):
+        sys.stderr.write("\r\033[K{}".format(progress.status()))
+        sys.stderr.flush()
+
+    sys.stderr.write("\r\033[K{}\n".format(progress.status()))
+
+
+class ContentStore(object):
+    """Download every Slack file once and link it into each channel.
+
+    Files are kept below the export root by their SHA-1 checksum. The first
+    job for a file ID is downloaded, later jobs for the same ID only get a
+    hard link (or a symbolic link where hard links are not possible) once the
+    content is available.
+    """
+
+    def __init__(self, root_directory, manifest):
+        self.directory = os.path.join(root_directory, STORE_NAME)
+        self.incoming = os.path.join(self.directory, "incoming")
+        self.manifest = manifest
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.stored = {}
+
+        if not os.path.isdir(self.incoming):
+            os.makedirs(self.incoming)
+
+        for file_id, checksum in manifest.checksums().items():
+            if os.path.isfile(self.blob_path(checksum)):
+                self.stored[file_id] = checksum
+
+    def blob_path(self, checksum):
+        """Return where content with the given checksum is stored."""
+
+        return os.path.join(self.directory, checksum[:2], checksum)
+
+    def claim(self, job):
+        """Tell whether the job has to be downloaded.
+
+        Jobs for files that are stored already are linked right away, jobs
+        for files that are still being downloaded are linked afterwards.
+        """
+
+        with self.lock:
+            checksum = self.stored.get(job.file_id)
+            if checksum is None:
+                if job.file_id in self.pending:
+                    self.pending[job.file_id].append(job)
+                    return False
+                self.pending[job.file_id] = [job]
+                return True
+
+        self.link(job, checksum)
+        return False
+
+    def link(self, job, checksum):
+        """Link stored content into the job's channel folder."""
+
+        blob = self.blob_path(checksum)
+        path = os.path.join(job.directory, job.filename)
+
+        if os.path.lexists(path):
+            os.remove(path)
+
+        try:
+            os.link(blob, path)
+        except OSError:
+            os.symlink(os.path.relpath(blob, job.directory), path)
+
+        self.manifest.record(job, os.path.getsize(blob), checksum)
+
+    def download(self, job, session, connections):
+        """Download the job's file into the store and link all its channels."""
+
+        partial_path = os.path.join(self.incoming,
+                                    "{}.part".format(job.file_id))
+
+        try:
+            size, checksum = fetch_with_retries(job.URL, partial_path,
+                                                session, connections)
+            check_size(job, size, partial_path)
+        except Exception, error:
+            with self.lock:
+                waiting = self.pending.pop(job.file_id)
+
+            # the job itself is counted by its worker
+            for waiting_job in waiting[1:]:
+                abandon_job(waiting_job, session, error)
+            raise
+
+        blob = self.blob_path(checksum)
+
+        with self.lock:
+            if not os.path.isdir(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob))
+            if os.path.exists(blob):
+                os.remove(partial_path)
+            else:
+                os.rename(partial_path, blob)
+            self.stored[job.file_id] = checksum
+            waiting = self.pending.pop(job.file_id)
+
+        self.link(job, checksum)
+
+        for waiting_job in waiting[1:]:
+            try:
+                self.link(waiting_job, checksum)
+            except EnvironmentError, error:
+                abandon_job(waiting_job, session, error)
+
+
+def abandon_job(job, session, error):
+    """Report and count a job waiting for a download which failed."""
+
+    session.progress.abandoned()
+    sys.stderr.write("Error: could not download {} into {}: {}\n".format(
+        job.URL, job.directory, error))
 
 
 def find_directories(root_directory):
@@ -29,7 +471,7 @@ def find_directories(root_directory):
         files_and_folders = os.listdir(root_directory)
         for item in files_and_folders:
             sub_directory = os.path.join(root_directory, item)
-            if os.path.isdir(sub_directory):
+            if os.path.isdir(sub_directory) and item != STORE_NAME:
                 search_directories.append(sub_directory)
         return search_directories
 
@@ -37,12 +479,75 @@ def find_directories(root_directory):
         sys.exit("Error: {} is not a valid directory".format(root_directory))
 
 
-def find_URLs(directory, options):
-    """Find URLs in JSON files."""
+def iterate_JSON_array(json_file, chunk_size=64 * 1024):
+    """Yield the items of a JSON array file one by one.
+
+    Only the item being decoded is held in memory, so huge day files are
+    scanned in constant memory instead of being loaded as a whole.
+    """
+
+    decoder = json.JSONDecoder()
+    buffer_ = ""
+    position = 0
+    read_size = chunk_size
+    started = False
+    finished = False
+
+    while True:
+        while position < len(buffer_) and buffer_[position] in " \t\r\n,":
+            position += 1
+
+        if position < len(buffer_):
+            if not started:
+                if buffer_[position] != "[":
+                    raise ValueError("Expected a JSON array")
+                started = True
+                position += 1
+                continue
+
+            if buffer_[position] == "]":
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer_, position)
+
+            # the item is incomplete, read on below
+            except ValueError:
+                if finished:
+                    raise
+
+            else:
+                # a number cut off by the end of the buffer, e.g. "12" of
+                # "123" or "1.5" of "1.5e3", goes on in the next chunk
+                if finished or (end < len(buffer_)
+                                and buffer_[end] in " \t\r\n,]"):
+                    buffer_ = buffer_[end:]
+                    position = 0
+                    read_size = chunk_size
+                    yield item
+                    continue
+
+        elif finished:
+            if started:
+                raise ValueError("Unterminated JSON array")
+            return
+
+        chunk = json_file.read(read_size)
+        if not chunk:
+            finished = True
+        buffer_ = buffer_[position:] + chunk
+        position = 0
+
+        # grow the reads for items larger than a chunk, so decoding them is
+        # not retried once per chunk
+        read_size *= 2
+
+
+def find_day_files(directory):
+    """Yield the opened JSON day files of a channel folder."""
 
     files = os.listdir(directory)
     filtered_files = []
-    files_for_download = []
     for item in files:
         if item.endswith(".json"):
             filtered_files.append(item)
@@ -51,53 +556,458 @@ def find_URLs(directory, options):
         file_path = os.path.join(directory, item)
 
         with open(file_path, "r") as json_file:
-            payload = json.load(json_file)
-            for message in payload:
-                if ("subtype" in message
-                        and message.get("subtype") == "file_share"):
+            yield json_file
+
+
+def find_archived_channels(archive):
+    """Return a dictionary of channel names to their day files in a zip."""
+
+    channels = {}
 
-                    download_URL = message.get("file").get("url_download")
+    for name in archive.namelist():
+        channel, _, day = name.partition("/")
 
-                    if options.remote_name:
-                        download_filename = message.get("file").get("id")
-                    else:
-                        download_filename = message.get("file").get("name")
-                        if download_filename.startswith("-."):
-                            download_filename = download_filename.lstrip("-")
-                            download_filename = "{}{}".format(
-                                message.get("file").get("id"),
-                                download_filename)
+        # files at the top level describe the workspace, not a channel
+        if (channel in ("", ".", "..") or "/" in day
+                or not day.endswith(".json")):
+            continue
 
-                    files_for_download.append(
-                        (download_filename, download_URL))
+        channels.setdefault(channel, []).append(name)
 
-    download_URLs(files_for_download, directory)
+    return channels
 
 
-def download_URLs(files_for_download, directory):
-    """Download the files."""
+def find_archived_day_files(archive, members):
+    """Yield the opened JSON day files of a channel inside a zip."""
 
-    for pair in files_for_download:
-        path = os.path.join(directory, pair[0])
-        download = urllib2.urlopen(pair[1])
+    for member in members:
+        json_file = archive.open(member)
+        try:
+            yield json_file
+        finally:
+            json_file.close()
 
-        content = download.read()
 
-        with open(path, "wb") as downloaded_file:
-            downloaded_file.write(content)
+def find_channels(export):
+    """Return the export root and a list of (channel folder, day files).
+
+    A zip file is read in place, its channel folders are created in a folder
+    named like the zip file without extension.
+    """
+
+    if os.path.isfile(export) and zipfile.is_zipfile(export):
+        root_directory = os.path.splitext(export)[0]
+        archive = zipfile.ZipFile(export)
+        channels = []
+
+        for channel, members in find_archived_channels(archive).items():
+            directory = os.path.join(root_directory, channel)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            channels.append((directory,
+                             find_archived_day_files(archive, members)))
+
+        return root_directory, channels
+
+    channels = []
+
+    for directory in find_directories(export):
+        channels.append((directory, find_day_files(directory)))
+
+    return export, channels
+
+
+def find_URLs(directory, day_files, options):
+    """Find URLs in JSON files and yield them as download jobs."""
+
+    for json_file in day_files:
+        for message in iterate_JSON_array(json_file):
+            if ("subtype" in message
+                    and message.get("subtype") == "file_share"):
+
+                download_URL = message.get("file").get("url_download")
+                file_id = message.get("file").get("id")
+                size = message.get("file").get("size")
+
+                if options.remote_name:
+                    download_filename = message.get("file").get("id")
+                else:
+                    download_filename = message.get("file").get("name")
+                    if download_filename.startswith("-."):
+                        download_filename = download_filename.lstrip("-")
+                        download_filename = "{}{}".format(
+                            message.get("file").get("id"),
+                            download_filename)
+
+                yield Job(directory, download_filename, download_URL,
+                          file_id, size)
+
+
+def open_URL(URL, connections, timeout, headers=None, redirects=5):
+    """Request a URL, reusing a kept-alive connection to its host.
+
+    `connections` maps (scheme, host) to an open connection and belongs to a
+    single worker, so no locking is needed. The response has to be read to
+    the end before the connection can serve the next request. A stalled
+    server fails the request after timeout seconds instead of blocking the
+    worker.
+    """
+
+    parts = urlparse.urlsplit(URL)
+    key = (parts.scheme, parts.netloc)
+    path = urlparse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+
+    while True:
+        connection = connections.get(key)
+        reused = connection is not None
+
+        if not reused:
+            if parts.scheme == "https":
+                connection = httplib.HTTPSConnection(parts.netloc,
+                                                     timeout=timeout)
+            else:
+                connection = httplib.HTTPConnection(parts.netloc,
+                                                    timeout=timeout)
+            connections[key] = connection
+
+        try:
+            connection.request("GET", path, headers=headers or {})
+            response = connection.getresponse()
+            break
+
+        # the server may have dropped an idle connection, retry once on a
+        # fresh one
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            del connections[key]
+            if not reused:
+                raise
+
+    if response.status in REDIRECT_CODES and redirects > 0:
+        location = urlparse.urljoin(URL, response.getheader("location"))
+        response.read()
+        return open_URL(location, connections, timeout, headers,
+                        redirects - 1)
+
+    if response.status not in (200, 206):
+        response.read()
+        raise urllib2.HTTPError(URL, response.status, response.reason,
+                                response.msg, None)
+
+    return response
+
+
+def close_connections(connections):
+    """Close all connections held by a worker."""
+
+    for connection in connections.values():
+        connection.close()
+    connections.clear()
+
+
+def hash_file(path, checksum, chunk_size):
+    """Feed an existing file into a checksum, return its size."""
+
+    size = 0
+
+    with open(path, "rb") as existing_file:
+        while True:
+            chunk = existing_file.read(chunk_size)
+            if not chunk:
+                return size
+            checksum.update(chunk)
+            size += len(chunk)
+
+
+def fetch_to_file(URL, partial_path, chunk_size, timeout, connections,
+                  progress=None):
+    """Stream a URL into a ".part" file, return its size and SHA-1.
+
+    A ".part" file left over from an earlier run is continued with a range
+    request, or taken as it is when it already holds the whole file.
+    """
+
+    checksum = hashlib.sha1()
+    size = 0
+    download = None
+
+    if os.path.isfile(partial_path):
+        size = hash_file(partial_path, checksum, chunk_size)
+        download = open_range(URL, connections, timeout, size)
+
+        # the run which wrote it stopped before renaming it
+        if download == "complete":
+            return size, checksum.hexdigest()
+
+    # the server ignored the range, start over
+    if download is None or download.status != 206:
+        checksum = hashlib.sha1()
+        size = 0
+
+    if download is None:
+        download = open_URL(URL, connections, timeout)
+
+    expected = get_content_length(download)
+    received = 0
+
+    try:
+        with open(partial_path, "ab" if size else "wb") as downloaded_file:
+            while True:
+                chunk = download.read(chunk_size)
+                if not chunk:
+                    break
+                downloaded_file.write(chunk)
+                checksum.update(chunk)
+                received += len(chunk)
+                if progress is not None:
+                    progress.transferred(len(chunk))
+    finally:
+        download.close()
+
+    # httplib ends reads quietly when the server closes the connection early,
+    # a retry continues the ".part" file
+    if expected is not None and received < expected:
+        raise httplib.IncompleteRead("", expected - received)
+
+    return size + received, checksum.hexdigest()
+
+
+def get_content_length(response):
+    """Return the body size a response announced, or None."""
+
+    try:
+        return int(response.getheader("content-length"))
+
+    # missing, e.g. with chunked transfer encoding, or not a number
+    except (TypeError, ValueError):
+        return None
+
+
+def open_range(URL, connections, timeout, start):
+    """Request a URL from a byte offset on.
+
+    Returns the response, "complete" if the file is no longer than start or
+    None if the ".part" file cannot be continued and has to be fetched anew.
+    """
+
+    try:
+        download = open_URL(URL, connections, timeout,
+                            {"Range": "bytes={}-".format(start)})
+
+    except urllib2.HTTPError, error:
+        if error.code != 416:
+            raise
+
+        content_range = parse_content_range(error.hdrs)
+        if content_range is not None and content_range[1] == start:
+            return "complete"
+        return None
+
+    if download.status != 206:
+        return download
+
+    content_range = parse_content_range(download.msg)
+    if content_range is not None and content_range[0] == start:
+        return download
+
+    # the rest of the answer cannot be skipped, drop the connection with it
+    download.close()
+    close_connections(connections)
+    return None
+
+
+def parse_content_range(headers):
+    """Return first byte and total size of a Content-Range header.
+
+    Either is None when the server left it out, the whole is None when the
+    header is missing or not understood.
+    """
+
+    match = CONTENT_RANGE.match(headers.get("Content-Range") or "")
+    if not match:
+        return None
+
+    first, total = match.groups()
+    return (int(first) if first is not None else None,
+            int(total) if total != "*" else None)
+
+
+def get_retry_after(error):
+    """Return the pause in seconds a server asked for, or None."""
+
+    try:
+        return max(0.0, float(error.hdrs.get("Retry-After")))
+
+    # missing or given as HTTP date
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def get_backoff(attempt):
+    """Return a jittered, exponentially growing pause before a retry."""
+
+    return random.uniform(0, min(MAXIMUM_BACKOFF, 2 ** attempt))
+
+
+def fetch_with_retries(URL, partial_path, session, connections):
+    """Fetch a URL into a ".part" file, retrying transient failures.
+
+    Throttling (429) and server errors (5xx) are retried, as are network
+    errors. A retry continues the ".part" file where the last attempt ended.
+    """
+
+    options, limiter = session.options, session.limiter
+    attempt = 0
+
+    while True:
+        limiter.acquire()
+
+        start = time.time()
+
+        try:
+            result = fetch_to_file(URL, partial_path, options.chunk_size,
+                                   options.timeout, connections,
+                                   session.progress)
+
+        except urllib2.HTTPError, error:
+            if ((error.code != 429 and error.code < 500)
+                    or attempt >= options.retries):
+                raise
+
+            retry_after = get_retry_after(error)
+            pause = max(retry_after, get_backoff(attempt))
+
+            if error.code == 429:
+                limiter.throttled(pause)
+
+        except (urllib2.URLError, httplib.HTTPException, IOError):
+            if attempt >= options.retries:
+                raise
+
+            # the connection may be left mid-response
+            close_connections(connections)
+            pause = get_backoff(attempt)
+
+        else:
+            limiter.succeeded()
+            session.progress.finished(result[0], time.time() - start)
+            return result
+
+        session.progress.retried()
+        time.sleep(pause)
+        attempt += 1
+
+
+def download_URL(job, session, connections):
+    """Stream a single file into its channel folder.
+
+    The file is written in chunks to a temporary ".part" file next to its
+    destination and only renamed into place once it is complete.
+    """
+
+    if session.store is not None:
+        session.store.download(job, session, connections)
+        return
+
+    path = os.path.join(job.directory, job.filename)
+    partial_path = "{}.part".format(path)
+
+    size, checksum = fetch_with_retries(job.URL, partial_path, session,
+                                        connections)
+    check_size(job, size, partial_path)
+
+    os.rename(partial_path, path)
+    session.manifest.record(job, size, checksum)
+
+
+def check_size(job, size, partial_path):
+    """Fail a download whose size differs from the one Slack announced.
+
+    The ".part" file is removed, so the next run fetches the file anew.
+    """
+
+    if job.size and size != job.size:
+        os.remove(partial_path)
+        raise IOError("received {} bytes of {}, Slack announced {}".format(
+            size, job.filename, job.size))
+
+
+def download_URLs(jobs, session):
+    """Download the files from the shared job queue until told to stop.
+
+    A file which fails is reported and counted, the worker carries on.
+    """
+
+    connections = {}
+
+    while True:
+        job = jobs.get()
+
+        try:
+            if job is None:
+                close_connections(connections)
+                return
+
+            session.progress.started(job)
+            download_URL(job, session, connections)
+            session.progress.stopped()
+
+        # a dead worker would leave the queue full and block main forever
+        except Exception, error:
+            session.progress.stopped(error)
+            sys.stderr.write("Error: could not download {}: {}\n".format(
+                job.URL, error))
+
+        finally:
+            jobs.task_done()
+
+
+def start_workers(jobs, session):
+    """Start a fixed number of download threads draining the job queue."""
+
+    workers = []
+
+    for _ in range(session.options.workers):
+        worker = threading.Thread(target=download_URLs, args=(jobs, session))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    return workers
 
 
 def parse_arguments():
     """Parse given command line arguments."""
 
-    text_folder = "the unzipped Slack export directory"
+    text_folder = "the Slack export directory or zip file"
     text_remote_name = "keep Slack file IDs instead of using the file names"
+    text_workers = "number of concurrent downloads (default: 8)"
+    text_chunk_size = "bytes read per chunk while downloading (default: 65536)"
+    text_deduplicate = ("download files shared into several channels once "
+                        "and link them into each channel folder")
+    text_rate = ("maximum requests per second across all workers, slowing "
+                 "down on 429 either way (default: 0, unlimited)")
+    text_retries = "attempts per file after the first one (default: 5)"
+    text_summary = "write a JSON summary of the run to this file"
+    text_timeout = ("seconds to wait for a server before a request fails "
+                    "(default: 60)")
 
     parser = argparse.ArgumentParser()
 
     parser.add_argument("folder", help=text_folder)
     parser.add_argument("--remote-name", help=text_remote_name,
                         action="store_true")
+    parser.add_argument("-w", "--workers", help=text_workers, type=int,
+                        default=8)
+    parser.add_argument("--chunk-size", help=text_chunk_size, type=int,
+                        default=64 * 1024)
+    parser.add_argument("--deduplicate", help=text_deduplicate,
+                        action="store_true")
+    parser.add_argument("--rate", help=text_rate, type=float, default=0.0)
+    parser.add_argument("--retries", help=text_retries, type=int, default=5)
+    parser.add_argument("--summary", help=text_summary, metavar="FILE")
+    parser.add_argument("--timeout", help=text_timeout, type=float,
+                        default=60.0)
 
     arguments = parser.parse_args()
     return arguments
@@ -108,12 +1018,68 @@ def main():
 
     options = parse_arguments()
 
-    directories = find_directories(options.folder)
-    process_pool = Pool(len(directories))
+    if options.workers < 1:
+        sys.exit("Error: at least one worker is required")
+    if options.chunk_size < 1:
+        sys.exit("Error: the chunk size must be positive")
+    if options.rate < 0 or options.retries < 0:
+        sys.exit("Error: the rate and retries must not be negative")
+    if options.timeout <= 0:
+        sys.exit("Error: the timeout must be positive")
+
+    root_directory, channels = find_channels(options.folder)
+    manifest = Manifest(root_directory)
+    store = None
+    limiter = RateLimiter(options.rate)
+    progress = Progress()
+
+    if options.deduplicate:
+        store = ContentStore(root_directory, manifest)
+
+    session = Session(options, manifest, store, limiter, progress)
+
+    stop_progress = threading.Event()
+    progress_view = None
+
+    if sys.stderr.isatty():
+        progress_view = threading.Thread(target=show_progress,
+                                         args=(progress, stop_progress))
+        progress_view.daemon = True
+        progress_view.start()
+
+    # bounded, so scanning channels never runs far ahead of the downloads
+    jobs = Queue.Queue(maxsize=options.workers * 4)
+    workers = start_workers(jobs, session)
+
+    for directory, day_files in channels:
+        for job in find_URLs(directory, day_files, options):
+            if manifest.completed(job):
+                progress.already_done()
+                continue
+            if store is None or store.claim(job):
+                progress.queued()
+                jobs.put(job)
+
+    for _ in workers:
+        jobs.put(None)
+
+    for worker in workers:
+        worker.join()
+
+    manifest.close()
+
+    if progress_view is not None:
+        stop_progress.set()
+        progress_view.join()
 
-    function_call = partial(find_URLs, options=options)
+    if options.summary:
+        with open(options.summary, "w") as summary_file:
+            json.dump(progress.summary(options.workers), summary_file,
+                      indent=2, sort_keys=True)
 
-    process_pool.map(function_call, directories)
+    if progress.failed:
+        sys.exit("Error: {} files could not be downloaded".format(
+            progress.failed))
 
 if __name__ == "__main__":
     main()
@@ -8,194 +8,1466 @@
 """
 Export posts and pages from Wordpress MySQL database to text files.
 
+Instead of a server, a (gzip compressed) mysqldump file or an SQLite copy of
+the tables can be read.
+
 Auto-drafts are not exported.
 Allows to use a non standard prefix for Wordpress tables.
-
-Depends on MySQLdb module.
+Large databases can be streamed with a server-side cursor in bounded memory.
+Incremental runs only rewrite what changed since the last export.
+Fetching, rendering and writing can overlap in a pipeline of threads.
+Instead of one file per post, everything can be written to a single JSON Lines
+file, SQLite database with a full-text index or tar archive.
+Media can be copied from an uploads folder or fetched from a server into
+media/, links to them are rewritten.
+All sites of a multisite installation can be exported at once, each into a
+folder named after its table prefix, from a server or an SQLite copy.
+
+Depends on MySQLdb module, unless reading from a dump file.
 """
 
 import argparse
+import copy
 import getpass
+import gzip
+import hashlib
+import httplib
+import io
+import json
+from multiprocessing import Pool
 import os
 import os.path
+import Queue
+import re
+import shutil
+import sqlite3
 import sys
+import tarfile
+import threading
+import time
+import urllib2
 
 # non standard modules
-import MySQLdb as mdb
+try:
+    import MySQLdb as mdb
+except ImportError:
+    mdb = None
+
+
+# folder media files are exported to, next to the exported folders
+MEDIA_DIRECTORY = "media"
+
+# connection of a worker process exporting sites, see start_site_worker
+SITE_WORKER = {}
+
+# errors transferring a media file, which is skipped and reported
+MEDIA_ERRORS = (IOError, OSError, httplib.HTTPException)
+
+# rows fetched ahead and entries waiting to be written in a pipeline
+PIPELINE_DEPTH = 64
+
+# remembers what an incremental export wrote, next to the exported folders
+STATE_FILE = ".export-state.json"
+
+# output formats writing records instead of Markdown text
+RECORD_FORMATS = ("jsonl", "sqlite")
+
+# columns of the table written by the sqlite output format
+RECORD_COLUMNS = ("ID", "type", "slug", "title", "date", "author", "tags",
+                  "categories", "modified", "permalink", "content")
+
+# columns of the posts table which are exported, instead of SELECT *
+CONTENT_COLUMNS = ("ID", "post_author", "post_date", "post_title",
+                   "post_name", "post_modified", "guid", "post_content",
+                   "post_content_filtered")
+
+# errors reading the database or dump which end the export with a message
+DATABASE_ERRORS = (IOError, ValueError, sqlite3.Error)
+if mdb is not None:
+    DATABASE_ERRORS = DATABASE_ERRORS + (mdb.Error,)
+
+# statements of interest in a mysqldump file
+CREATE_PATTERN = re.compile(r"CREATE TABLE `([^`]+)` \(")
+COLUMN_PATTERN = re.compile(r"\s+`([^`]+)` ")
+INSERT_PATTERN = re.compile(r"INSERT INTO `([^`]+)` (?:\(([^)]*)\) )?VALUES ")
+VALUE_PATTERN = re.compile(r"\s*(?:'([^'\\]*(?:\\.[^'\\]*)*)'|(NULL)|"
+                           r"(0x[0-9A-Fa-f]*)|([-+0-9.eE]+))\s*([,)])")
+ESCAPE_PATTERN = re.compile(r"\\(.)", re.DOTALL)
+ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a"}
+
+# "bytes 100-199/1000" of a partial answer or "bytes */1000" of a 416
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)")
 
 
 def main():
     """Export posts and pages from Wordpress MySQL database to text files."""
 
     options = parse_arguments()
-    connection = None
+    backend = None
+
+    if options.all_sites:
+        export_sites(options)
+        return
 
     try:
-        connection = connect(options)
-        authors = get_authors(connection, options.prefix)
-        posts = get_content(connection, "posts", options.prefix)
-        pages = get_content(connection, "pages", options.prefix)
+        backend = open_backend(options)
+        export_database(backend, options)
+
+    except DATABASE_ERRORS, error:
+        sys.exit("Error: {}".format(error))
+
+    finally:
+        if backend:
+            backend.close()
+
+
+def open_backend(options, password=None):
+    """Open the backend reading the chosen source."""
+
+    if options.dump:
+        return DumpBackend(options.dump, options.prefix)
+    elif options.sqlite:
+        return SQLiteBackend(options.sqlite, options.prefix)
+
+    return MySQLBackend(connect(options, password), options.prefix)
+
+
+def export_database(backend, options):
+    """Export posts and pages from a database backend.
+
+    Returns the number of exported posts and pages.
+    """
 
-        if posts:
-            export_content(posts, "posts", authors, options, connection)
-        if pages:
-            export_content(pages, "pages", authors, options, connection)
+    authors = backend.get_authors()
+    labels = None
+    state = None
+    since = None
+    media = None
 
-    except mdb.Error, error:
+    if options.include_categories or options.include_tags:
+        labels = backend.get_labels()
+
+    if options.incremental:
+        state = load_state(STATE_FILE)
+        since = state.get("post_modified")
+
+    # attachments are transferred while posts and pages are exported
+    if options.uploads or options.media_URL:
+        media = MediaExport(options, backend.get_attachments())
+
+    # when streaming, each query only runs once its export starts, so
+    # just one unbuffered result is open on the connection at a time
+    posts = backend.get_content("posts", options.stream_batch_size, since)
+    pages = backend.get_content("pages", options.stream_batch_size, since)
+
+    sink = open_sink(options, state)
+
+    exported = (export_content(posts, "posts", authors, options, sink,
+                               labels, media),
+                export_content(pages, "pages", authors, options, sink,
+                               labels, media))
+
+    sink.close()
+
+    if state is not None:
+        for content_type in ("posts", "pages"):
+            remove_stale_content(state, content_type,
+                                 backend.get_content_IDs(content_type))
+        save_state(STATE_FILE, state)
+
+    if media is not None:
+        media.close()
+
+    return exported
+
+
+def export_sites(options):
+    """Export every site of a multisite installation into its own folder.
+
+    Sites are exported concurrently by worker processes, each of which
+    keeps its own connection. Prints a line with the time taken per site.
+    """
+
+    password = None
+    if not (options.dump or options.sqlite):
+        password = ask_password(options)
+
+    backend = None
+
+    try:
+        backend = open_backend(options, password)
+        prefixes = find_site_prefixes(backend.get_tables(), options.prefix)
+    except DATABASE_ERRORS, error:
         sys.exit("Error: {}".format(error))
+    finally:
+        if backend:
+            backend.close()
+
+    if not prefixes:
+        sys.exit("Error: no sites with the prefix {} found".format(
+            options.prefix))
+
+    pool = Pool(min(options.site_workers, len(prefixes)), start_site_worker,
+                (options, password))
+    failed = 0
+    start = time.time()
+
+    print "{:<16} {:>8} {:>8} {:>10}".format("site", "posts", "pages", "time")
+
+    try:
+        for prefix, exported, elapsed, error in pool.imap_unordered(
+                export_site, prefixes):
+            if error is None:
+                print "{:<16} {:>8} {:>8} {:>8.2f} s".format(
+                    prefix, exported[0], exported[1], elapsed)
+            else:
+                failed += 1
+                print "{:<16} {:>8} {:>8} {:>8.2f} s  {}".format(
+                    prefix, "-", "-", elapsed, error)
+            sys.stdout.flush()
+
+        pool.close()
 
     finally:
-        if connection:
-            connection.close()
+        pool.terminate()
+        pool.join()
 
+    print "{} sites in {:.2f} s".format(len(prefixes), time.time() - start)
 
-def export_content(content, content_type, authors, options, connection=None):
-    """Write the exported content to files."""
+    if failed:
+        sys.exit("Error: {} of {} sites could not be exported".format(
+            failed, len(prefixes)))
 
-    if os.path.exists("./{}".format(content_type)) is False:
-        os.mkdir(content_type)
 
-    exported_authors = None
-    exported_tags = None
-    exported_categories = None
+def find_site_prefixes(tables, prefix):
+    """Return the table prefixes of all sites, e.g. wp, wp_2 and wp_3."""
+
+    pattern = re.compile(r"({}(?:_\d+)?)_posts$".format(re.escape(prefix)))
+    prefixes = []
+
+    for table in tables:
+        match = pattern.match(table)
+        if match:
+            prefixes.append(match.group(1))
+
+    return sorted(prefixes, key=lambda site: int(site[len(prefix) + 1:] or 0))
+
+
+def start_site_worker(options, password):
+    """Open the backend a worker process exports all of its sites with."""
+
+    SITE_WORKER["options"] = options
+    SITE_WORKER["backend"] = open_backend(options, password)
+
+
+def export_site(prefix):
+    """Export a site into a folder named after its prefix.
+
+    Runs in a worker process, returns the prefix, the number of exported
+    posts and pages, the time taken and the error if the export failed.
+    """
+
+    options = copy.copy(SITE_WORKER["options"])
+    backend = SITE_WORKER["backend"]
+    site = prefix[len(options.prefix) + 1:]
+    exported = None
+    error = None
+    start = time.time()
+
+    # media of the sites besides the main one live in sites/<number>
+    if site and options.uploads:
+        options.uploads = os.path.join(options.uploads, "sites", site)
+    if site and options.media_URL:
+        options.media_URL = "{}/sites/{}".format(
+            options.media_URL.rstrip("/"), site)
+
+    if not os.path.isdir(prefix):
+        os.mkdir(prefix)
+
+    directory = os.getcwd()
+    os.chdir(prefix)
+
+    try:
+        backend.select_site(prefix)
+        exported = export_database(backend, options)
+    except DATABASE_ERRORS, exception:
+        error = str(exception)
+    finally:
+        os.chdir(directory)
+
+    return prefix, exported, time.time() - start, error
+
+
+class SQLBackend(object):
+    """Read WordPress tables with SQL.
+
+    Subclasses wrap a database module, providing the connection, its
+    parameter placeholder and how rows are fetched as dictionaries.
+    """
+
+    placeholder = "%s"
+
+    def __init__(self, connection, prefix):
+        self.connection = connection
+        self.prefix = prefix
+        # sites of a multisite installation share the users table
+        self.users_prefix = prefix
+
+    def select_site(self, prefix):
+        """Read the tables of another site of a multisite installation."""
+
+        self.prefix = prefix
+
+    def get_tables(self):
+        """Get the names of all tables."""
+
+        raise NotImplementedError
+
+    def query(self, statement, parameters=()):
+        """Return all rows of a statement as dictionaries."""
+
+        raise NotImplementedError
+
+    def stream(self, statement, parameters, batch_size):
+        """Yield the rows of a statement fetched in batches."""
+
+        raise NotImplementedError
+
+    def get_authors(self):
+        """Get a dictionary of authors from the database."""
+
+        authors = {}
+
+        statement = "SELECT * FROM {}_users".format(self.users_prefix)
+
+        for user in self.query(statement):
+            authors.update({int(user["ID"]): user["display_name"]})
+
+        return authors
+
+    def get_labels(self):
+        """Fetch tags and categories of all posts and pages.
+
+        Returns a dictionary mapping post IDs to a dictionary of taxonomies
+        (e.g. "category" or "post_tag") and their label names.
+        """
+
+        labels = {}
+
+        statement = ("SELECT relationships.object_id, taxonomy.taxonomy, "
+                     "terms.name FROM {0}_term_relationships AS "
+                     "relationships JOIN {0}_term_taxonomy AS taxonomy ON "
+                     "relationships.term_taxonomy_id = "
+                     "taxonomy.term_taxonomy_id JOIN {0}_terms AS terms ON "
+                     "taxonomy.term_id = terms.term_id ORDER BY "
+                     "relationships.object_id, "
+                     "relationships.term_order".format(self.prefix))
+
+        for label in self.query(statement):
+            entry_labels = labels.setdefault(int(label["object_id"]), {})
+            entry_labels.setdefault(label["taxonomy"], []).append(
+                label["name"])
+
+        return labels
+
+    def get_content(self, content_type, batch_size=None, since=None):
+        """Get the posts/pages from the database.
+
+        With a batch size the rows are streamed in batches of that size
+        instead of being fetched all at once. With a date only rows modified
+        since then are returned.
+        """
+
+        content_statement = "SELECT {} {}".format(
+            ", ".join(CONTENT_COLUMNS),
+            get_content_condition(content_type, self.prefix))
+        parameters = ()
+
+        # entries modified within the same second as the last export are
+        # fetched again and skipped by comparing their checksum
+        if since is not None:
+            content_statement = "{} AND post_modified >= {}".format(
+                content_statement, self.placeholder)
+            parameters = (since,)
+
+        if batch_size:
+            return self.stream(content_statement, parameters, batch_size)
+
+        return self.query(content_statement, parameters)
+
+    def get_content_IDs(self, content_type):
+        """Get the IDs of all exported posts/pages from the database."""
+
+        statement = "SELECT ID {}".format(
+            get_content_condition(content_type, self.prefix))
+
+        return set(int(row["ID"]) for row in self.query(statement))
+
+    def get_attachments(self):
+        """Get the URL and path below the uploads folder of all media."""
+
+        statement = ("SELECT posts.guid, meta.meta_value FROM {0}_posts AS "
+                     "posts JOIN {0}_postmeta AS meta ON meta.post_id = "
+                     "posts.ID WHERE posts.post_type = 'attachment' AND "
+                     "meta.meta_key = '_wp_attached_file' ORDER BY "
+                     "posts.ID".format(self.prefix))
+
+        return [(row["guid"], row["meta_value"])
+                for row in self.query(statement)]
+
+    def close(self):
+        """Close the connection."""
+
+        self.connection.close()
+
+
+class MySQLBackend(SQLBackend):
+    """Read WordPress tables from a MySQL connection.
+
+    Streaming uses an unbuffered server-side cursor.
+    """
+
+    def query(self, statement, parameters=()):
+        """Return all rows of a statement as dictionaries."""
+
+        cursor = self.connection.cursor(mdb.cursors.DictCursor)
+        cursor.execute(statement, parameters)
+
+        return cursor.fetchall()
+
+    def get_tables(self):
+        """Get the names of all tables in the database."""
+
+        statement = ("SELECT TABLE_NAME FROM information_schema.TABLES "
+                     "WHERE TABLE_SCHEMA = DATABASE()")
+
+        return [row["TABLE_NAME"] for row in self.query(statement)]
+
+    def stream(self, statement, parameters, batch_size):
+        """Yield the rows of a statement fetched in batches from the server."""
+
+        cursor = self.connection.cursor(mdb.cursors.SSDictCursor)
+
+        try:
+            cursor.execute(statement, parameters)
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+
+        finally:
+            cursor.close()
+
+
+class SQLiteBackend(SQLBackend):
+    """Read WordPress tables from an SQLite file, e.g. for benchmarks."""
+
+    placeholder = "?"
+
+    def __init__(self, path, prefix):
+        if not os.path.isfile(path):
+            raise IOError("{} does not exist".format(path))
+
+        # rows may be fetched by the producer thread of a pipelined export
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.text_factory = str
+
+        SQLBackend.__init__(self, connection, prefix)
+
+    def query(self, statement, parameters=()):
+        """Return all rows of a statement as dictionaries."""
+
+        cursor = self.connection.execute(statement, parameters)
+
+        return [dict(row) for row in cursor.fetchall()]
+
+    def get_tables(self):
+        """Get the names of all tables in the file."""
+
+        statement = "SELECT name FROM sqlite_master WHERE type = 'table'"
+
+        return [row["name"] for row in self.query(statement)]
+
+    def stream(self, statement, parameters, batch_size):
+        """Yield the rows of a statement fetched in batches."""
+
+        cursor = self.connection.execute(statement, parameters)
+
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
+
+        finally:
+            cursor.close()
+
+
+class DumpBackend(object):
+    """Read WordPress tables from a mysqldump file, optionally gzipped.
+
+    The dump is streamed line by line, relying on mysqldump writing every
+    INSERT statement on a single line. A first pass collects users and
+    labels, every call of get_content streams the posts table once more.
+    """
+
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+        self.tables = None
+        self.content_IDs = {}
+
+    def open(self):
+        """Open the dump, decompressing it if necessary."""
+
+        with open(self.path, "rb") as dump_file:
+            compressed = dump_file.read(2) == "\x1f\x8b"
+
+        if compressed:
+            return gzip.open(self.path, "rb")
+        return open(self.path, "rb")
+
+    def read_rows(self, tables):
+        """Yield (table, row) for every row inserted into the given tables.
+
+        Table names are given without prefix, rows as dictionaries.
+        """
+
+        wanted = dict(("{}_{}".format(self.prefix, table), table)
+                      for table in tables)
+        columns = {}
+
+        with self.open() as dump_file:
+            lines = iter(dump_file)
+
+            for line in lines:
+                if line.startswith("CREATE TABLE"):
+                    match = CREATE_PATTERN.match(line)
+                    if match and match.group(1) in wanted:
+                        columns[match.group(1)] = read_columns(lines)
+
+                elif line.startswith("INSERT INTO"):
+                    match = INSERT_PATTERN.match(line)
+                    if not match or match.group(1) not in wanted:
+                        continue
+
+                    if match.group(2):
+                        names = [name.strip(" `")
+                                 for name in match.group(2).split(",")]
+                    elif match.group(1) in columns:
+                        names = columns[match.group(1)]
+                    else:
+                        raise ValueError("No columns known for table {} in "
+                                         "{}".format(match.group(1),
+                                                     self.path))
+
+                    for values in parse_values(line.rstrip("\r\n"),
+                                               match.end()):
+                        yield wanted[match.group(1)], dict(zip(names, values))
+
+    def load_tables(self):
+        """Collect users and label tables in a single pass."""
+
+        if self.tables is not None:
+            return self.tables
+
+        self.tables = {"users": [], "terms": [], "term_taxonomy": [],
+                       "term_relationships": []}
+
+        for table, row in self.read_rows(self.tables.keys()):
+            self.tables[table].append(row)
+
+        return self.tables
+
+    def get_authors(self):
+        """Get a dictionary of authors."""
+
+        authors = {}
+
+        for user in self.load_tables()["users"]:
+            authors.update({int(user["ID"]): user["display_name"]})
+
+        return authors
+
+    def get_labels(self):
+        """Get a dictionary of post IDs to their labels."""
+
+        tables = self.load_tables()
+        names = dict((term["term_id"], term["name"])
+                     for term in tables["terms"])
+        taxonomies = dict((taxonomy["term_taxonomy_id"], taxonomy)
+                          for taxonomy in tables["term_taxonomy"])
+        labels = {}
+
+        relationships = sorted(tables["term_relationships"],
+                               key=lambda row: (row["object_id"],
+                                                row.get("term_order", 0)))
+
+        for relationship in relationships:
+            taxonomy = taxonomies.get(relationship["term_taxonomy_id"])
+            if taxonomy is None or taxonomy["term_id"] not in names:
+                continue
+
+            entry_labels = labels.setdefault(int(relationship["object_id"]),
+                                             {})
+            entry_labels.setdefault(taxonomy["taxonomy"], []).append(
+                names[taxonomy["term_id"]])
+
+        return labels
+
+    def get_content(self, content_type, batch_size=None, since=None):
+        """Stream the posts/pages, optionally only those modified since.
+
+        The batch size does not apply, dumps are always streamed.
+        """
+
+        post_type = get_post_type(content_type)
+        IDs = self.content_IDs[content_type] = set()
+
+        for _, row in self.read_rows(["posts"]):
+            if row["post_type"] != post_type:
+                continue
+            if row["post_status"] == "auto-draft":
+                continue
+
+            IDs.add(int(row["ID"]))
+
+            if since is None or str(row["post_modified"]) >= since:
+                yield row
+
+    def get_content_IDs(self, content_type):
+        """Get the IDs of all exported posts/pages.
+
+        Only known once get_content has been read to the end.
+        """
+
+        return self.content_IDs[content_type]
+
+    def get_attachments(self):
+        """Get the URL and path below the uploads folder of all media.
+
+        Takes another pass over the dump, reading posts and their metadata.
+        """
+
+        URLs = {}
+        paths = {}
+
+        for table, row in self.read_rows(["posts", "postmeta"]):
+            if table == "posts":
+                if row["post_type"] == "attachment":
+                    URLs[int(row["ID"])] = row["guid"]
+            elif row["meta_key"] == "_wp_attached_file":
+                paths[int(row["post_id"])] = row["meta_value"]
+
+        return [(URLs[ID], path) for ID, path in sorted(paths.items())
+                if ID in URLs]
+
+    def close(self):
+        """Nothing to close, the dump is only open while reading."""
+
+        pass
+
+
+def read_columns(lines):
+    """Read the column names of a CREATE TABLE statement."""
+
+    columns = []
+
+    for line in lines:
+        match = COLUMN_PATTERN.match(line)
+        if not match:
+            break
+        columns.append(match.group(1))
+
+    return columns
+
+
+def unescape(text):
+    """Resolve the backslash escapes of a string literal in a dump."""
+
+    if "\\" not in text:
+        return text
+
+    return ESCAPE_PATTERN.sub(lambda match: ESCAPES.get(match.group(1),
+                                                        match.group(1)), text)
+
+
+def parse_values(line, position):
+    """Yield the rows of an INSERT statement's VALUES as lists."""
+
+    while True:
+        if line[position:position + 1] != "(":
+            raise ValueError("Unexpected dump content: {}".format(
+                line[position:position + 40]))
+        position += 1
+        values = []
+
+        while True:
+            match = VALUE_PATTERN.match(line, position)
+            if not match:
+                raise ValueError("Unexpected dump content: {}".format(
+                    line[position:position + 40]))
+
+            string, null, hexadecimal, number, end = match.groups()
+
+            if string is not None:
+                values.append(unescape(string))
+            elif null:
+                values.append(None)
+            elif hexadecimal:
+                values.append(hexadecimal[2:].decode("hex"))
+            elif "." in number or "e" in number or "E" in number:
+                values.append(float(number))
+            else:
+                values.append(int(number))
+
+            position = match.end()
+            if end == ")":
+                break
+
+        yield values
+
+        if line[position:position + 1] != ",":
+            return
+        position += 1
 
-    for entry in content:
 
-        if options.include_author:
-            exported_authors = authors
+class MarkdownSink(object):
+    """Write every entry to its own Markdown file, e.g. posts/slug.md.
 
-        if (options.include_categories or options.include_tags) and connection:
-            labels = get_labels(entry, options.prefix, connection)
+    Given the state of an incremental export, files whose content did not
+    change are left alone.
+    """
 
-            if options.include_categories:
-                exported_categories = labels.get("category")
-            if options.include_tags:
-                exported_tags = labels.get("post_tag")
+    def __init__(self, state=None):
+        self.state = state
 
-        export = build_export(entry, options, exported_authors, exported_tags,
-                              exported_categories)
+    def write(self, content_type, entry, export):
+        """Write the export text of an entry to its file."""
 
-        with open(os.path.join(content_type, entry["post_name"])
-                  + ".md", "w") as textfile:
+        if os.path.exists("./{}".format(content_type)) is False:
+            os.mkdir(content_type)
+
+        path = os.path.join(content_type, entry["post_name"]) + ".md"
+
+        if self.state is not None and not update_state(
+                self.state, content_type, entry, path, export):
+            return
+
+        with open(path, "w") as textfile:
             textfile.write(export)
 
+    def close(self):
+        """Nothing to close, every file is closed once written."""
+
+        pass
+
+
+class JSONLinesSink(object):
+    """Write one JSON record per line to a file (gzipped for .gz) or stdout."""
+
+    def __init__(self, path=None):
+        if path is None:
+            self.output = sys.stdout
+        elif path.endswith(".gz"):
+            self.output = gzip.open(path, "wb")
+        else:
+            self.output = open(path, "wb", 1024 * 1024)
+
+    def write(self, content_type, entry, record):
+        """Append the record of an entry."""
+
+        record["type"] = content_type
+        self.output.write(json.dumps(record, sort_keys=True))
+        self.output.write("\n")
+
+    def close(self):
+        """Flush the records, close the file unless writing to stdout."""
+
+        if self.output is sys.stdout:
+            self.output.flush()
+        else:
+            self.output.close()
+
+
+class SQLiteSink(object):
+    """Write records into a table of a new SQLite file.
+
+    Titles and content get a full-text index, built once all records are
+    inserted. The file is only moved into place once it is complete.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.partial_path = "{}.tmp".format(path)
+        self.rows = []
+
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+        self.connection = sqlite3.connect(self.partial_path)
+        self.connection.text_factory = str
+        # nothing to recover, the file is only used once complete
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute(
+            "CREATE TABLE entries (ID INTEGER, type TEXT, slug TEXT, "
+            "title TEXT, date TEXT, author TEXT, tags TEXT, categories TEXT, "
+            "modified TEXT, permalink TEXT, content TEXT, "
+            "PRIMARY KEY (type, ID))")
+        self.connection.execute(
+            "CREATE VIRTUAL TABLE search USING fts4(content=\"entries\", "
+            "title, content)")
+
+    def write(self, content_type, entry, record):
+        """Queue the record of an entry, insert full batches."""
+
+        record["type"] = content_type
+
+        for field in ("tags", "categories"):
+            if record[field] is not None:
+                record[field] = ",".join(record[field])
+
+        self.rows.append(tuple(record[column] for column in RECORD_COLUMNS))
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert the queued records."""
 
-def get_labels(entry, prefix, connection):
-    """Fetch tags and categories from the database."""
+        self.connection.executemany(
+            "INSERT INTO entries ({}) VALUES ({})".format(
+                ", ".join(RECORD_COLUMNS),
+                ", ".join("?" for _ in RECORD_COLUMNS)), self.rows)
+        self.rows = []
+
+    def close(self):
+        """Insert what is left, build the index and move the file in place."""
+
+        self.flush()
+        self.connection.execute(
+            "INSERT INTO search (search) VALUES ('rebuild')")
+        self.connection.commit()
+        self.connection.close()
+
+        os.rename(self.partial_path, self.path)
+
+
+class TarSink(object):
+    """Stream the Markdown files into a tar archive (gzipped for .gz/.tgz).
+
+    Writes to stdout without a path, the archive is never seeked.
+    """
+
+    def __init__(self, path=None):
+        compression = "gz" if path and path.endswith((".gz", ".tgz")) else ""
+
+        if path is None:
+            self.archive = tarfile.open(fileobj=sys.stdout,
+                                        mode="w|{}".format(compression))
+        else:
+            self.archive = tarfile.open(path, "w|{}".format(compression))
+
+        self.mtime = time.time()
+
+    def write(self, content_type, entry, export):
+        """Add the export text of an entry as e.g. posts/slug.md."""
+
+        info = tarfile.TarInfo("{}/{}.md".format(content_type,
+                                                 entry["post_name"]))
+        info.size = len(export)
+        info.mtime = self.mtime
+        info.mode = 0644
+
+        self.archive.addfile(info, io.BytesIO(export))
+
+    def close(self):
+        """Finish the archive."""
+
+        self.archive.close()
+
+
+def open_sink(options, state=None):
+    """Return the sink writing the chosen output format."""
+
+    if options.format == "jsonl":
+        return JSONLinesSink(options.output)
+    elif options.format == "sqlite":
+        return SQLiteSink(options.output)
+    elif options.format == "tar":
+        return TarSink(options.output)
+
+    return MarkdownSink(state)
+
+
+class MediaExport(object):
+    """Copy or fetch media files into the media folder, rewriting links.
+
+    Every attachment and every other file below the uploads URL which is
+    linked from the content (e.g. resized images) is transferred once by a
+    pool of threads. Complete files are skipped, so an interrupted export
+    resumes when run again, partially fetched files are continued.
+    """
+
+    def __init__(self, options, attachments):
+        self.uploads = options.uploads
+        self.URL = options.media_URL
+        self.pattern = get_media_pattern(attachments)
+        self.queued = set()
+        self.failed = []
+
+        # Markdown files live in posts/ or pages/, records in no folder
+        if options.format in RECORD_FORMATS:
+            self.link = "{}/".format(MEDIA_DIRECTORY)
+        else:
+            self.link = "../{}/".format(MEDIA_DIRECTORY)
 
-    labels = {}
+        # unbounded, all attachments are queued before the export starts
+        self.queue = Queue.Queue()
+        self.workers = []
 
-    statement = ("SELECT term_taxonomy_id FROM {}_term_relationships "
-                 "WHERE object_id = {}".format(prefix, entry["ID"]))
+        for _ in range(options.media_workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
 
-    cursor = connection.cursor(mdb.cursors.DictCursor)
+        for _, path in attachments:
+            self.add(path)
 
-    cursor.execute(statement)
-    unresolved_labels = cursor.fetchall()
+    def add(self, path):
+        """Queue a path below the uploads folder, unless seen before."""
 
-    for label in unresolved_labels:
+        if path in self.queued or not is_safe_path(path):
+            return
+
+        self.queued.add(path)
+        self.queue.put(path)
+
+    def rewrite(self, export):
+        """Point links to uploaded media at the media folder.
+
+        Takes export text or a record, whose content is rewritten.
+        """
+
+        if self.pattern is None:
+            return export
+
+        if isinstance(export, dict):
+            export["content"] = self.pattern.sub(self.replace_link,
+                                                 export["content"])
+            return export
+
+        return self.pattern.sub(self.replace_link, export)
+
+    def replace_link(self, match):
+        """Queue a linked media file, return its link in the export."""
+
+        path = urllib2.unquote(match.group(1))
+
+        if not is_safe_path(path):
+            return match.group(0)
+
+        self.add(path)
+
+        return self.link + match.group(1)
+
+    def work(self):
+        """Transfer queued files until None is queued."""
+
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+
+            try:
+                self.transfer(path)
+            except MEDIA_ERRORS, error:
+                self.failed.append(path)
+                print >> sys.stderr, "Failed to export {}: {}".format(path,
+                                                                      error)
+
+    def transfer(self, path):
+        """Copy or fetch a file, unless it was exported before."""
+
+        target = os.path.join(MEDIA_DIRECTORY, *path.split("/"))
+        if os.path.exists(target):
+            return
+
+        directory = os.path.dirname(target)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another worker may have created it in the meantime
+            if not os.path.isdir(directory):
+                raise
+
+        partial_path = "{}.part".format(target)
+
+        if self.uploads:
+            source = os.path.join(self.uploads, *path.split("/"))
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+            # linking is instant, copy across filesystems
+            try:
+                os.link(source, partial_path)
+            except OSError:
+                shutil.copyfile(source, partial_path)
+        else:
+            fetch_media("{}/{}".format(self.URL.rstrip("/"),
+                                       urllib2.quote(path)), partial_path)
+
+        os.rename(partial_path, target)
+
+    def close(self):
+        """Wait for the transfers, fail if files could not be exported."""
+
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+        if self.failed:
+            raise IOError("{} of {} media files could not be exported".format(
+                len(self.failed), len(self.queued)))
+
+
+def get_media_pattern(attachments):
+    """Compile a pattern matching links below the uploads URL.
+
+    The uploads URL is found by stripping the path from attachment URLs,
+    links match with either scheme. Returns None without attachments.
+    """
+
+    bases = set()
+
+    for URL, path in attachments:
+        if URL and path and URL.endswith(path):
+            bases.add(URL[:-len(path)].split("://", 1)[-1])
+
+    if not bases:
+        return None
+
+    # the longest base first, in case one contains another
+    alternatives = "|".join(re.escape(base) for base in
+                            sorted(bases, key=len, reverse=True))
+
+    return re.compile(r"https?://(?:{})([^\s\"'()<>?#]+)".format(
+        alternatives))
+
+
+def is_safe_path(path):
+    """Return whether a path stays below the folder it is relative to."""
+
+    return (bool(path) and not path.startswith("/")
+            and ".." not in path.split("/"))
+
+
+def fetch_media(URL, partial_path):
+    """Fetch a URL into a file, continuing a partial one if possible.
+
+    A partial file which already holds the whole file is kept as it is.
+    """
+
+    offset = 0
+    response = None
+
+    if os.path.exists(partial_path):
+        offset = os.path.getsize(partial_path)
+        request = urllib2.Request(URL)
+        request.add_header("Range", "bytes={}-".format(offset))
 
-        statement = ("SELECT name from {}_terms where term_id "
-                     "= {}".format(prefix, label.get("term_taxonomy_id")))
-        cursor.execute(statement)
-        result = cursor.fetchall()
         try:
-            label_name = result[0].get("name")
+            response = urllib2.urlopen(request, timeout=60)
+
+        # the run which fetched it stopped before renaming it
+        except urllib2.HTTPError, error:
+            if error.code != 416:
+                raise
+            if get_range_total(error.info()) == offset:
+                return
+
+        # servers ignoring the range send the whole file again, an answer
+        # starting elsewhere cannot be appended
+        if response is not None and response.getcode() == 206:
+            if get_range_start(response.info()) != offset:
+                response.close()
+                response = None
+
+    if response is None:
+        offset = 0
+        response = urllib2.urlopen(URL, timeout=60)
+
+    try:
+        if response.getcode() != 206:
+            offset = 0
+        expected = get_content_length(response.info())
+
+        with open(partial_path, "ab" if offset else "wb") as media_file:
+            shutil.copyfileobj(response, media_file, 64 * 1024)
+
+    finally:
+        response.close()
+
+    # reading ends quietly when the server closes the connection early, the
+    # partial file is continued by the next run
+    received = os.path.getsize(partial_path) - offset
+    if expected is not None and received < expected:
+        raise IOError("Received {} of {} bytes".format(received, expected))
+
+
+def get_content_length(headers):
+    """Return the body size announced in the headers, or None."""
+
+    try:
+        return int(headers.get("Content-Length"))
+
+    # missing, e.g. with chunked transfer encoding, or not a number
+    except (TypeError, ValueError):
+        return None
 
-        # there is a empty, reserved next label available, so expect to
-        # read on an invalid error once.
-        except IndexError:
+
+def get_range_start(headers):
+    """Return the first byte of a Content-Range header, or None."""
+
+    match = CONTENT_RANGE_PATTERN.match(headers.get("Content-Range") or "")
+    if not match or match.group(1) is None:
+        return None
+
+    return int(match.group(1))
+
+
+def get_range_total(headers):
+    """Return the total size of a Content-Range header, or None."""
+
+    match = CONTENT_RANGE_PATTERN.match(headers.get("Content-Range") or "")
+    if not match or match.group(2) == "*":
+        return None
+
+    return int(match.group(2))
+
+
+def export_content(content, content_type, authors, options, sink,
+                   labels=None, media=None):
+    """Render the content and hand it to the sink, return how many entries.
+
+    Given a media export, links to media are rewritten first. In a pipeline
+    a thread of its own writes to the sink while the next entries are
+    fetched and rendered.
+    """
+
+    exported = 0
+    entries = render_content(content, authors, options, labels)
+
+    if not options.pipeline:
+        for entry, export in entries:
+            if media is not None:
+                export = media.rewrite(export)
+
+            sink.write(content_type, entry, export)
+            exported += 1
+
+        return exported
+
+    queue = Queue.Queue(maxsize=PIPELINE_DEPTH)
+    errors = []
+    writer = threading.Thread(target=write_entries,
+                              args=(sink, queue, errors))
+    writer.daemon = True
+    writer.start()
+
+    try:
+        for entry, export in entries:
+            # the writer failed, rendering more would be in vain
+            if errors:
+                break
+
+            if media is not None:
+                export = media.rewrite(export)
+
+            queue.put((content_type, entry, export))
+            exported += 1
+
+    finally:
+        queue.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+    return exported
+
+
+def write_entries(sink, queue, errors):
+    """Hand queued entries to the sink until None is queued.
+
+    Runs in its own thread. After an error, which is kept for the caller,
+    the queue is still drained so the caller is not blocked.
+    """
+
+    for task in iter(queue.get, None):
+        if errors:
             continue
 
-        statement = ("SELECT taxonomy FROM {}_term_taxonomy WHERE term_id "
-                     "= {}".format(prefix, label.get("term_taxonomy_id")))
-        cursor.execute(statement)
-        result = cursor.fetchall()
-        label_type = result[0].get("taxonomy")
+        try:
+            sink.write(*task)
+        except Exception, error:
+            errors.append(error)
+
+
+def get_render_arguments(entry, authors, options, labels):
+    """Collect the arguments of build_export for an entry."""
+
+    exported_authors = None
+    exported_tags = None
+    exported_categories = None
+
+    # only the entry's own author
+    if options.include_author:
+        exported_authors = {entry["post_author"]:
+                            authors[entry["post_author"]]}
+
+    if labels is not None:
+        entry_labels = labels.get(int(entry["ID"]), {})
+
+        if options.include_categories:
+            exported_categories = entry_labels.get("category")
+        if options.include_tags:
+            exported_tags = entry_labels.get("post_tag")
+
+    return (entry, options, exported_authors, exported_tags,
+            exported_categories)
+
+
+def render_entry(arguments):
+    """Render one entry, return it together with its export text.
+
+    Formats storing records get the entry's record instead of text.
+    """
+
+    if arguments[1].format in RECORD_FORMATS:
+        return arguments[0], build_record(*arguments)
+
+    return arguments[0], build_export(*arguments)
+
+
+def produce_entries(tasks, queue, stop):
+    """Move rows from the database into a bounded queue.
+
+    Runs in its own thread, so fetching overlaps with rendering and writing.
+    Errors are handed over to the consumer, the queue ends with None. Stops
+    early once the consumer gave up.
+    """
+
+    try:
+        for task in tasks:
+            if stop.is_set():
+                return
+            queue.put(task)
+    except Exception, error:
+        queue.put(error)
+    else:
+        queue.put(None)
 
-        if not labels.get(label_type):
-            labels.update({label_type: [label_name]})
-        else:
-            labels.get(label_type).append(label_name)
 
-    return labels
+def render_content(content, authors, options, labels):
+    """Yield entries together with their export text.
+
+    In a pipeline a thread fetches rows while the caller renders them, at
+    most PIPELINE_DEPTH rows ahead. Rendering is a few joins, cheaper than
+    handing rows to other processes, so it stays in the caller.
+    """
+
+    tasks = (get_render_arguments(entry, authors, options, labels)
+             for entry in content)
+
+    if not options.pipeline:
+        for task in tasks:
+            yield render_entry(task)
+        return
+
+    queue = Queue.Queue(maxsize=PIPELINE_DEPTH)
+    stop = threading.Event()
+    producer = threading.Thread(target=produce_entries,
+                                args=(tasks, queue, stop))
+    producer.daemon = True
+    producer.start()
+
+    try:
+        for task in iter(queue.get, None):
+            if isinstance(task, Exception):
+                raise task
+
+            yield render_entry(task)
+
+    finally:
+        # a producer blocked on the full queue would never see the stop
+        stop.set()
+        while producer.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+def load_state(path):
+    """Read the state of the last incremental export, if there was one."""
+
+    if not os.path.exists(path):
+        return {"post_modified": None, "posts": {}, "pages": {}}
+
+    with open(path, "r") as state_file:
+        return json.load(state_file)
+
+
+def save_state(path, state):
+    """Replace the incremental export state in one step."""
+
+    with open("{}.tmp".format(path), "w") as state_file:
+        json.dump(state, state_file, indent=1, sort_keys=True)
+
+    os.rename("{}.tmp".format(path), path)
+
+
+def update_state(state, content_type, entry, path, export):
+    """Record an exported entry, return whether its file has to be written.
+
+    Removes the entry's previous file if its slug changed.
+    """
+
+    modified = str(entry["post_modified"])
+    if state["post_modified"] is None or modified > state["post_modified"]:
+        state["post_modified"] = modified
+
+    checksum = hashlib.sha1(export).hexdigest()
+    entries = state[content_type]
+    previous = entries.get(str(entry["ID"]))
+    entries[str(entry["ID"])] = {"path": path, "sha1": checksum}
+
+    if previous is not None:
+        if previous["path"] != path and os.path.exists(previous["path"]):
+            os.remove(previous["path"])
+        elif previous["sha1"] == checksum and os.path.exists(path):
+            return False
+
+    return True
+
+
+def remove_stale_content(state, content_type, current_IDs):
+    """Remove files of entries which are no longer exported.
+
+    That covers deleted entries as well as entries which became auto-drafts
+    or changed their type.
+    """
+
+    entries = state[content_type]
+
+    for ID in entries.keys():
+        if int(ID) not in current_IDs:
+            if os.path.exists(entries[ID]["path"]):
+                os.remove(entries[ID]["path"])
+            del entries[ID]
 
 
 def build_export(entry, options, authors=None, tags=None, categories=None):
-    """Construct the export text which is written to the file."""
+    """Construct the export text which is written to the file.
 
-    export = "Title: {}\n".format(entry["post_title"])
-    export = export + "Date: {}\n".format(entry["post_date"])
+    Collects the lines and joins them once, so the content is copied a
+    single time however many labels there are.
+    """
 
-    if tags:
-        tags_string = ""
-        for tag in tags:
-            tags_string = tags_string + tag + ","
-        export = export + "Tags: {}\n".format(tags_string)
+    lines = ["Title: {}".format(entry["post_title"]),
+             "Date: {}".format(entry["post_date"])]
 
+    # labels keep their trailing comma
+    if tags:
+        lines.append("Tags: {},".format(",".join(tags)))
     if categories:
-        category_string = ""
-        for category in categories:
-            category_string = category_string + category + ","
-        export = export + "Categories: {}\n".format(category_string)
+        lines.append("Categories: {},".format(",".join(categories)))
 
     if authors:
-        export = export + "Authors: {}\n".format(authors[entry["post_author"]])
+        lines.append("Authors: {}".format(authors[entry["post_author"]]))
 
     if options.include_modified_date:
-        export = export + "Modified: {}\n".format(entry["post_modified"])
+        lines.append("Modified: {}".format(entry["post_modified"]))
     if options.include_published_url:
-        export = export + "Permalink: {}\n".format(entry["guid"])
+        lines.append("Permalink: {}".format(entry["guid"]))
 
-    # special casing for historical posts (e.g. imported from tumblr)
-    if entry["post_content_filtered"] == "":
-        export = export + "\n{}\n".format(entry["post_content"])
-    else:
-        export = export + "\n{}\n".format(entry["post_content_filtered"])
+    lines.extend(["", get_entry_content(entry), ""])
 
-    return export
+    return "\n".join(lines)
 
 
-def get_authors(connection, prefix):
-    """Get a dictionary of authors from the database."""
+def build_record(entry, options, authors=None, tags=None, categories=None):
+    """Construct the record which is written by structured output formats.
 
-    authors = {}
+    Holds the same fields as the text of build_export, those which are not
+    included are None.
+    """
 
-    statement = "SELECT * FROM {}_users".format(prefix)
-    cursor = connection.cursor(mdb.cursors.DictCursor)
+    record = {"ID": int(entry["ID"]),
+              "slug": entry["post_name"],
+              "title": entry["post_title"],
+              "date": str(entry["post_date"]),
+              "tags": tags or None,
+              "categories": categories or None,
+              "author": None,
+              "modified": None,
+              "permalink": None,
+              "content": get_entry_content(entry)}
 
-    cursor.execute(statement)
-    results = cursor.fetchall()
+    if authors:
+        record["author"] = authors[entry["post_author"]]
 
-    for user in results:
-        authors.update({int(user["ID"]): user["display_name"]})
+    if options.include_modified_date:
+        record["modified"] = str(entry["post_modified"])
+    if options.include_published_url:
+        record["permalink"] = entry["guid"]
 
-    return authors
+    return record
 
 
-def get_content(connection, content_type, prefix):
-    """Get the posts/pages from the database."""
+def get_entry_content(entry):
+    """Return the content of an entry."""
+
+    # special casing for historical posts (e.g. imported from tumblr)
+    if entry["post_content_filtered"] == "":
+        return entry["post_content"]
+
+    return entry["post_content_filtered"]
+
+
+def get_post_type(content_type):
+    """Return the WordPress post type of a content type."""
 
     if content_type == "pages":
-        content_statement = ("SELECT * FROM {}_posts WHERE post_type ="
-                             " 'page' AND post_status NOT LIKE 'auto-draft'")
-        content_statement.format(prefix)
+        return "page"
 
     elif content_type == "posts":
-        content_statement = ("SELECT * FROM {}_posts WHERE post_type ="
-                             " 'post' AND post_status NOT LIKE 'auto-draft'")
-        content_statement.format(prefix)
+        return "post"
 
     else:
         raise TypeError("{} is not a recognized type of content.".format(
             content_type))
 
-    cursor = connection.cursor(mdb.cursors.DictCursor)
-    cursor.execute(content_statement)
 
-    content = cursor.fetchall()
+def get_content_condition(content_type, prefix):
+    """Return the statement selecting the exported rows of a content type."""
+
+    post_type = get_post_type(content_type)
 
-    return content
+    return ("FROM {}_posts WHERE post_type = '{}' AND post_status NOT LIKE "
+            "'auto-draft'".format(prefix, post_type))
 
 
 def parse_arguments():
@@ -211,11 +1483,35 @@ def parse_arguments():
     text_tags = "Include tags for posts and pages."
     text_categories = "Include categories for posts and pages."
     text_author = "Include post or page author."
+    text_stream = ("Stream posts and pages from the server in batches of "
+                   "this size instead of loading them all at once.")
+    text_incremental = ("Only rewrite posts and pages modified since the "
+                        "last incremental export and remove deleted ones.")
+    text_pipeline = ("Fetch, render and write posts and pages in threads "
+                     "of their own, overlapping the database and the disk.")
+    text_dump = ("Read a mysqldump file (optionally gzipped) instead of "
+                 "connecting to a server.")
+    text_sqlite = ("Read the WordPress tables from an SQLite file instead of "
+                   "connecting to a server.")
+    text_format = ("Write Markdown files, JSON Lines, an SQLite database with "
+                   "a full-text index or a tar archive (default:markdown)")
+    text_output = ("File the jsonl, sqlite and tar formats write to, gzipped "
+                   "for .gz (default:stdout, required for sqlite)")
+    text_uploads = ("Export media into media/ by copying them from this "
+                    "wp-content/uploads folder.")
+    text_media_URL = ("Export media into media/ by fetching them below this "
+                      "URL, e.g. http://example.com/wp-content/uploads")
+    text_media_workers = "Media files transferred at once (default:8)"
+    text_all_sites = ("Export all sites of a multisite installation, e.g. "
+                      "the tables prefixed wp, wp_2 and wp_3, each into a "
+                      "folder named after its prefix.")
+    text_site_workers = ("Sites exported at once with --all-sites, each "
+                         "with its own connection (default:4)")
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("server", help=text_server,)
-    parser.add_argument("database", help=text_database,)
+    parser.add_argument("server", help=text_server, nargs="?")
+    parser.add_argument("database", help=text_database, nargs="?")
 
     parser.add_argument("-u", "--user", help=text_user, default="root")
     parser.add_argument("-p", "--prefix", help=text_prefix, default="wp")
@@ -230,9 +1526,67 @@ def parse_arguments():
                         action='store_true')
     parser.add_argument("--include-author", help=text_author,
                         action='store_true')
+    parser.add_argument("--stream", help=text_stream, type=int,
+                        metavar="BATCH_SIZE", dest="stream_batch_size")
+    parser.add_argument("--incremental", help=text_incremental,
+                        action='store_true')
+    parser.add_argument("--pipeline", help=text_pipeline,
+                        action='store_true')
+    sources = parser.add_mutually_exclusive_group()
+    sources.add_argument("--dump", help=text_dump, metavar="FILE")
+    sources.add_argument("--sqlite", help=text_sqlite, metavar="FILE")
+    parser.add_argument("-f", "--format", help=text_format,
+                        default="markdown",
+                        choices=["markdown", "jsonl", "sqlite", "tar"])
+    parser.add_argument("-o", "--output", help=text_output, metavar="FILE")
+    media_sources = parser.add_mutually_exclusive_group()
+    media_sources.add_argument("--uploads", help=text_uploads,
+                               metavar="FOLDER")
+    media_sources.add_argument("--media-URL", help=text_media_URL,
+                               metavar="URL")
+    parser.add_argument("--media-workers", help=text_media_workers, type=int,
+                        default=8)
+    parser.add_argument("--all-sites", help=text_all_sites,
+                        action='store_true')
+    parser.add_argument("--site-workers", help=text_site_workers, type=int,
+                        default=4)
 
     arguments = parser.parse_args()
 
+    if (not (arguments.dump or arguments.sqlite)
+            and not (arguments.server and arguments.database)):
+        parser.error("server and database are required without --dump or "
+                     "--sqlite")
+
+    if arguments.format == "markdown" and arguments.output:
+        parser.error("--output does not apply to the markdown format")
+    if arguments.format == "sqlite" and not arguments.output:
+        parser.error("--output is required for the sqlite format")
+    if arguments.incremental and arguments.format != "markdown":
+        parser.error("--incremental only applies to the markdown format")
+    if arguments.uploads and not os.path.isdir(arguments.uploads):
+        parser.error("{} is not a folder".format(arguments.uploads))
+    if arguments.media_workers < 1:
+        parser.error("at least one media worker is required")
+
+    if arguments.all_sites:
+        # every site would read the whole dump several times
+        if arguments.dump:
+            parser.error("--all-sites can not read a dump, load it into "
+                         "SQLite and use --sqlite")
+        if arguments.site_workers < 1:
+            parser.error("at least one site worker is required")
+        if arguments.format != "markdown" and (
+                not arguments.output or os.path.isabs(arguments.output)):
+            parser.error("--all-sites needs an --output relative to the "
+                         "folders of the sites")
+
+        # sites are exported from within their folders
+        for name in ("dump", "sqlite", "uploads"):
+            if getattr(arguments, name):
+                setattr(arguments, name,
+                        os.path.abspath(getattr(arguments, name)))
+
     return arguments
 
 
@@ -247,10 +1601,16 @@ def ask_password(options):
     return password
 
 
-def connect(options):
-    """Open a connection to the database."""
+def connect(options, password=None):
+    """Open a connection to the database, asking for the password if needed."""
+
+    if mdb is None:
+        sys.exit("Error: the MySQLdb module is required to connect to a "
+                 "server.")
+
+    if password is None:
+        password = ask_password(options)
 
-    password = ask_password(options)
     connection = mdb.connect(options.server, options.user, password,
                              options.database)
 